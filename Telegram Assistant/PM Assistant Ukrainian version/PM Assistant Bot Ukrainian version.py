@@ -2,29 +2,103 @@ import logging
 import json
 import os
 import csv
+import asyncio
+import hashlib
+import heapq
+import hmac
+import html
+import math
+import multiprocessing
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram.enums import ContentType
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from datetime import datetime, timedelta, timezone
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.date import DateTrigger
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import setup_application
+from aiohttp import web
 import dateparser  # Додано для кращого парсингу дат
 
+# Необов'язкові швидші кодеки знімків
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Налаштування
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+slow_log = logging.getLogger("slow_updates")  # Один JSON-запис на кожне оновлення, повільніше за SLOW_UPDATE_SECONDS
 
 # Константи
-DATA_FILE = "pm_manager_data.json"
-BOT_TOKEN = "YOUR_BOT_TOKEN_HERE" # 🔐 ВАЖЛИВО: вставте свій токен, отриманий через @BotFather
+DATA_FILE = "pm_manager_data.json"  # Старий формат з одним файлом, переноситься при старті
+STORAGE_BACKEND = "json"  # "json" (знімок + файли журналу) або "sqlite"
+SQLITE_FILE = "pm_manager_data.db"
+FSM_FILE = "pm_manager_fsm.db"  # Стани діалогів, спільні для робочих процесів
+FSM_STATE_TTL = 7 * 24 * 3600  # Через скільки секунд покинутий стан діалогу забувається
+REMINDERS_FILE = "pm_manager_reminders.db"  # Заплановані нагадування, відновлюються при старті
+REMINDER_GRACE_HOURS = 24  # Нагадування, пропущені поки бот не працював, надсилаються при старті, якщо вони не старші за це
+SAVE_DELAY = 0.25  # Скільки секунд збирати зміни в один запис на диск
+MAX_LOADED_USERS = 1000  # Скільки чатів тримати в пам'яті, найдовше неактивні вивантажуються
+DATA_DIR = "pm_manager_data"  # Окремий файл для кожного чату
+SNAPSHOT_FORMAT = "binary"  # "binary" (orjson або msgpack, швидко завантажується, без них - стислий JSON) або "json" (читабельний)
+SNAPSHOT_GENERATIONS = 3  # Скільки файлів знімків зберігати для чату, від найновішого
+JOURNAL_COMPACT_EVERY = 100  # Кількість записів журналу між повними перезаписами знімка
+LEGACY_DATA_OWNER = None  # Id чату, який отримує задачі з DATA_FILE
+BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE") # 🔐 ВАЖЛИВО: вставте свій токен, отриманий через @BotFather
+RUN_MODE = os.getenv("RUN_MODE", "polling")  # "polling" або "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публічна https-адреса цього сервера, порожня - вебхук не реєструється (локальне тестування)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Telegram надсилає його з кожним оновленням, інші запити відхиляються
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_UPDATES = 40  # Скільки оновлень обробляється одночасно, решту Telegram притримує до відповіді на ці
+WORKERS = int(os.getenv("WORKERS", "0"))  # Скільки робочих процесів ділять між собою чати, 0 - оновлення обробляються в цьому процесі
+WORKER_MAX_UPDATES = 40  # Скільки оновлень один робочий процес обробляє одночасно
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))  # Порт ендпоінта /metrics, робочі процеси використовують наступні, 0 вимикає
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "1.0"))  # Оновлення, що тривають довше, записуються в журнал повільних
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}  # Користувачі, яким дозволено /profile
+PROFILE_SECONDS = 10  # Тривалість /profile за замовчуванням
+PROFILE_MAX_SECONDS = 120
+PROFILE_INTERVAL = 0.005  # Секунд між знімками стеків
+PROFILE_TOP = 15  # Функцій у звіті профілювання
 EXPORT_FOLDER = "exports"
+FUZZY_SEARCH_LIMIT = 10  # Скільки найкращих збігів показувати в нечіткому пошуку
+SNIPPET_WIDTH = 80  # Скільки символів тексту показувати навколо нечіткого збігу
+MESSAGE_LIMIT = 4096  # Обмеження Telegram на довжину одного повідомлення
+GLOBAL_SEND_RATE = 30  # Повідомлень на секунду в усі чати, обмеження Telegram
+CHAT_SEND_RATE = 1  # Повідомлень на секунду в один чат
+CHAT_SEND_BURST = 3  # Скільки повідомлень чат може отримати одразу, до початку обмеження
+MAX_SEND_RETRIES = 3  # Повторів запиту, який Telegram відхилив з retry_after
+PAGE_SIZE = 20  # Скільки елементів на сторінці списків задач і нотаток
+PAGE_LINE_LIMIT = (MESSAGE_LIMIT - 256) // PAGE_SIZE  # Довші рядки списку обрізаються, щоб повна сторінка вміщалась в одне повідомлення
+SEARCH_LIMIT = 20  # Скільки найкращих збігів показувати в пошуку
+DUE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"  # Нормалізовані UTC-дедлайни, як рядки сортуються за часом
 DEFAULT_CATEGORIES = ["Робота", "Особисте", "Навчанє"]
 
 # Перевірка токена (додано нову перевірку)
@@ -32,19 +106,214 @@ if not BOT_TOKEN or len(BOT_TOKEN) < 30:
     logger.error("Помилка: Невірний формат токена бота!")
     exit(1)
 
+# Метрики
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # Паузи retry_after можуть тривати хвилини
+
+class Histogram:
+    """Гістограма Prometheus, з окремою серією для кожного значення мітки"""
+
+    def __init__(self, name, help_text, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}  # значення мітки -> [кількість в кожному кошику..., кількість понад останній кошик, сума]
+
+    def observe(self, value, label_value=None):
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self.series.items(), key=lambda item: str(item[0])):
+            labels = f'{self.label}="{label_value}",' if self.label else ""
+            count = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), series):
+                count += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {count}')
+            labels = f"{{{labels[:-1]}}}" if labels else ""
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+update_seconds = Histogram("pm_update_seconds", "Час від надходження оновлення до завершення його обробки", "type")
+handler_seconds = Histogram("pm_handler_seconds", "Час роботи кожного обробника оновлень", "handler")
+save_seconds = Histogram("pm_save_seconds", "Час запису змін або знімка чату")
+save_bytes = Histogram("pm_save_bytes", "Байтів записано за одне збереження, лише файлове сховище", buckets=SIZE_BUCKETS)
+dateparser_seconds = Histogram("pm_dateparser_seconds", "Час, за який dateparser розбирає дедлайн")
+bot_api_seconds = Histogram("pm_bot_api_seconds", "Затримка запитів до Bot API", "method")
+reminder_lag_seconds = Histogram("pm_reminder_lag_seconds", "Наскільки пізніше свого часу надсилаються нагадування")
+outbound_wait_seconds = Histogram("pm_outbound_wait_seconds", "Скільки запит до чату чекав на свою чергу відправки, разом з паузами retry_after", buckets=WAIT_BUCKETS)
+HISTOGRAMS = [update_seconds, handler_seconds, save_seconds, save_bytes, dateparser_seconds, bot_api_seconds, reminder_lag_seconds,
+              outbound_wait_seconds]
+
+# Профілювання
+# Місця, де потоки чекають на роботу, їхні знімки не враховуються
+IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("thread.py", "_worker"), ("queue.py", "get")}
+# Потоки, заблоковані читанням з каналу, як робочий процес, що чекає на оновлення
+IDLE_FILES = (os.path.join("multiprocessing", "connection.py"),)
+profiling = False
+
+def frame_key(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def is_idle(frame):
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES or code.co_filename.endswith(IDLE_FILES)
+
+def sample_stacks(seconds):
+    """Знімає стеки інших потоків протягом `seconds` секунд.
+    Повертає кількість знімків і, для кожної функції, як часто вона виконувалась сама
+    і як часто була будь-де в стеку
+    """
+    own = Counter()
+    total = Counter()
+    samples = 0
+    current = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == current or is_idle(frame):
+                continue
+            samples += 1
+            own[frame_key(frame)] += 1
+            on_stack = set()
+            while frame is not None:
+                on_stack.add(frame_key(frame))
+                frame = frame.f_back
+            total.update(on_stack)
+        time.sleep(PROFILE_INTERVAL)
+    return samples, own, total
+
+# Стани діалогів
+FSM_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fsm_updated ON fsm (updated);
+"""
+
+class SQLiteFSMStorage(BaseStorage):
+    """Зберігає стани діалогів в SQLite, тож вони переживають перезапуск і спільні для робочих процесів
+
+    Зміни збираються протягом SAVE_DELAY і записуються однією транзакцією в потоці сховища.
+    Стани, яких не торкались FSM_STATE_TTL, вважаються зниклими і час від часу видаляються.
+    Читання обслуговуються з кешу нещодавно використаних станів, відсутній теж читається в потоці
+    сховища, тож цикл подій ніколи не чекає на SQLite.
+    """
+
+    def __init__(self, path):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # Використовується лише з потоку сховища
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(FSM_SCHEMA)
+        self.cache = OrderedDict()  # ключ -> [стан, дані, час останньої зміни], від найдовше невикористаного
+        self.pending = {}  # ключ -> [стан, дані], ще не записані
+        self.writing = {}  # Зміни, що записуються саме зараз
+        self.cleaned = 0.0
+        self._flush_task = None
+
+    async def load(self, key):
+        key = self.key_builder.build(key)
+        entry = self.cache.get(key)
+        if entry is None:
+            entry = self.pending.get(key) or self.writing.get(key)
+            if entry is not None:
+                entry = [*entry, time.time()]
+            else:
+                # Стає в чергу після вже зроблених записів; стан, збережений тим часом, важливіший за прочитаний
+                entry = self.cache.setdefault(key, await run_in_storage(self.read, key))
+            self.cache[key] = entry
+            # Чати потрапляють лише до свого робочого процесу, тож інший процес не змінює кешований стан
+            while len(self.cache) > MAX_LOADED_USERS:
+                self.cache.popitem(last=False)
+        self.cache.move_to_end(key)
+        if entry[2] < time.time() - FSM_STATE_TTL:
+            return [None, {}, entry[2]]
+        return entry
+
+    def read(self, key):
+        row = self.conn.execute("SELECT state, data, updated FROM fsm WHERE key = ?", (key,)).fetchone()
+        return [row[0], json.loads(row[1]), row[2]] if row else [None, {}, 0.0]
+
+    def store(self, key, state, data):
+        key = self.key_builder.build(key)
+        self.pending[key] = [state, data]
+        self.cache[key] = [state, data, time.time()]
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush(SAVE_DELAY))
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        self.store(key, state, (await self.load(key))[1])
+
+    async def get_state(self, key):
+        return (await self.load(key))[0]
+
+    async def set_data(self, key, data):
+        self.store(key, (await self.load(key))[0], dict(data))
+
+    async def get_data(self, key):
+        return dict((await self.load(key))[1])
+
+    async def flush(self, delay=0):
+        await asyncio.sleep(delay)
+        if not self.pending:
+            return
+        self.writing, self.pending = self.pending, {}
+        try:
+            await run_in_storage(self.write, self.writing)
+        except Exception as e:
+            logger.error(f"Помилка збереження стану діалогу: {e}")
+        finally:
+            self.writing = {}
+
+    def write(self, changes):
+        now = time.time()
+        with self.conn:
+            # Після завершеного діалогу нічого зберігати
+            self.conn.executemany(
+                "DELETE FROM fsm WHERE key = ?",
+                [(key,) for key, (state, data) in changes.items() if state is None and not data]
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO fsm (key, state, data, updated) VALUES (?, ?, ?, ?)",
+                [(key, state, json.dumps(data, ensure_ascii=False), now)
+                 for key, (state, data) in changes.items() if state is not None or data]
+            )
+            if now - self.cleaned > 3600:
+                self.conn.execute("DELETE FROM fsm WHERE updated < ?", (now - FSM_STATE_TTL,))
+                self.cleaned = now
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+
 # Ініціалізація
 os.makedirs(EXPORT_FOLDER, exist_ok=True)
+os.makedirs(DATA_DIR, exist_ok=True)
 
 try:
     bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
-    scheduler = AsyncIOScheduler()
+    fsm_storage = SQLiteFSMStorage(FSM_FILE)
+    dp = Dispatcher(storage=fsm_storage)
 except Exception as e:
     logger.error(f"Помилка ініціалізації бота: {e}")
     exit(1)
 
-# Для зберігання ID останніх повідомлень (max 3 на користувача)
-user_messages = {}
+# Для зберігання ID останніх повідомлень (max 3 на користувача), MAX_LOADED_USERS останніх активних чатів
+user_messages = OrderedDict()
 
 # Обробник для всіх небажаних типів контенту
 @dp.message(F.content_type.in_({
@@ -83,6 +352,7 @@ class NoteStates(StatesGroup):
 
 class SearchStates(StatesGroup):
     waiting_for_search_query = State()
+    waiting_for_fuzzy_query = State()
 
 class ExportStates(StatesGroup):
     waiting_for_export_format = State()
@@ -90,70 +360,1315 @@ class ExportStates(StatesGroup):
 class SettingsStates(StatesGroup):
     waiting_for_new_category = State()
 
-# Функції для роботи з даними
-def load_data():
-    default_data = {
-        "tasks": [],
-        "notes": [],
-        "categories": DEFAULT_CATEGORIES.copy(),
-        "statistics": {}
-    }
-    
-    if not os.path.exists(DATA_FILE):
-        return default_data
+# Покращена функція парсингу дедлайнів
+def parse_deadline(deadline_str, now=None):
+    if not deadline_str:
+        return None
     
+    # Відносні дедлайни ("через 3 дні") залежать від часу, тому результати кешуються на хвилину
+    now = (now or datetime.now()).replace(second=0, microsecond=0)
+    return _parse_deadline(deadline_str, now)
+
+@lru_cache(maxsize=1024)
+def _parse_deadline(deadline_str, now):
     try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            
-            # Міграція старих даних
-            if isinstance(data.get("tasks", []), list) and len(data.get("tasks", [])) > 0 and isinstance(data["tasks"][0], str):
-                data["tasks"] = [{
-                    "text": task.split(" — ")[0], 
-                    "deadline": task.split(" — ")[1] if " — " in task else "", 
-                    "category": "", 
-                    "created": str(datetime.now()),
-                    "completed": False,
-                    "completed_at": None
-                } for task in data.get("tasks", [])]
+        # Використовуємо dateparser для гнучкого парсингу
+        started = time.perf_counter()
+        parsed_date = dateparser.parse(
+            deadline_str,
+            languages=['uk', 'ru', 'en'],
+            settings={'PREFER_DATES_FROM': 'future', 'RELATIVE_BASE': now}
+        )
+        dateparser_seconds.observe(time.perf_counter() - started)
+        
+        if parsed_date:
+            # Якщо дата в минулому (наприклад, для "15.12"), додаємо рік
+            if parsed_date < now:
+                if len(deadline_str) <= 5:  # Формати типу "15.12" або "14:30"
+                    if ':' in deadline_str:  # Час без дати
+                        parsed_date = parsed_date.replace(year=now.year + 1)
+                    else:  # Дата без року
+                        parsed_date = parsed_date.replace(year=now.year + 1)
             
-            # Перевірка наявності всіх необхідних полів
-            for task in data.get("tasks", []):
-                task.setdefault("completed", False)
-                task.setdefault("completed_at", None)
-                task.setdefault("created", str(datetime.now()))
+            return parsed_date
+        
+        return None
+    except Exception as e:
+        logger.error(f"Помилка парсингу дедлайну '{deadline_str}': {e}")
+        return None
+
+def normalize_deadline(deadline_str, created=None):
+    """Розбирає дедлайн задачі у UTC-час "due", що зберігається поруч з ним"""
+    try:
+        # Відносний дедлайн задачі рахується від часу її створення
+        now = datetime.fromisoformat(created) if created else None
+    except ValueError:
+        now = None
+    deadline = parse_deadline(deadline_str, now)
+    return format_due(deadline) if deadline else None
+
+def format_due(moment):
+    return moment.astimezone(timezone.utc).strftime(DUE_FORMAT)
+
+def due_to_datetime(due):
+    return datetime.strptime(due, DUE_FORMAT).replace(tzinfo=timezone.utc)
+
+# Пошук
+def normalize(text):
+    # Нижній регістр, апострофи всередині українських слів (п'ять, м’ята) прибираються
+    return re.sub(r"['’ʼ`]", "", text.lower())
+
+def tokenize(text):
+    return re.findall(r"\w+", normalize(text))
+
+@lru_cache(maxsize=65536)
+def trigrams(word):
+    # Кешується, ті самі слова трапляються в багатьох елементах; змінювати множину не можна
+
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+def word_bigrams(word):
+    # З доповненням, щоб перша і остання літери теж враховувались
+    padded = f"^{word}$"
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+def max_typos(word):
+    """Відстань редагування, яка ще вважається опискою в слові такої довжини"""
+    return 0 if len(word) <= 2 else 1 if len(word) <= 5 else 2
+
+def edit_distance(a, b, limit):
+    """Відстань редагування між a і b, де переставлені сусідні літери - одна описка,
+    або limit + 1, щойно стає ясно, що вона більша за limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, previous = None, list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                distance = min(distance, before[j - 2] + 1)
+            current.append(distance)
+        # Перестановка сягає на два рядки назад, тож обидва мають бути понад ліміт
+        if min(current) > limit and min(previous) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+def highlight(text, words, width=SNIPPET_WIDTH):
+    """HTML-уривок тексту навколо першого з даних слів, усі вони виділені жирним"""
+    spans = [match.span() for match in re.finditer(r"[\w'’ʼ`]+", text) if normalize(match.group()) in words]
+    start = max(0, spans[0][0] - width // 4) if spans and len(text) > width else 0
+    end = min(len(text), start + width)
+    parts = ["…" if start else ""]
+    position = start
+    for span_start, span_end in spans:
+        if span_start >= position and span_end <= end:
+            parts.append(html.escape(text[position:span_start]))
+            parts.append(f"<b>{html.escape(text[span_start:span_end])}</b>")
+            position = span_end
+    parts.append(html.escape(text[position:end]))
+    parts.append("…" if end < len(text) else "")
+    return "".join(parts)
+
+def search_fields(item):
+    # Задачі шукаються також за дедлайном, нотатки - лише за текстом і категорією.
+    # Поля перевіряються окремо, тож збіг не може захопити два з них
+    return (item["text"], item.get("category", ""), item.get("deadline", ""))
+
+class SearchIndex:
+    """Інвертовані індекси задач і нотаток чату: слово і триграма -> елементи, що їх містять"""
+
+    def __init__(self):
+        self.postings = {}  # Слово -> {id елемента: скільки разів слово трапляється в елементі}
+        self.words = []  # Проіндексовані слова, відсортовані для пошуку за префіксом
+        self.items = {}  # Id елемента -> (вид, елемент)
+        self.texts = {}  # Id елемента -> його нормалізовані поля для перевірки кандидатів з триграм
+        self.trigrams = {}  # Триграма -> id елементів, у яких є слово з нею
+        self.word_bigrams = {}  # Біграма -> проіндексовані слова з нею, для пошуку кандидатів з описками
+
+    def add(self, kind, item):
+        for word in self.index(kind, item):
+            insort(self.words, word)
+
+    def add_all(self, items):
+        """Індексує багато пар (вид, елемент) одразу, список слів сортується один раз, а не для кожного нового слова"""
+        for kind, item in items:
+            self.index(kind, item, with_trigrams=False)
+        self.words = sorted(self.postings)
+        # Триграми заповнюються за словами, а не за елементами, для багатьох елементів це набагато менше кроків
+        for word, posting in self.postings.items():
+            for gram in trigrams(word):
+                self.trigrams.setdefault(gram, set()).update(posting)
+
+    def index(self, kind, item, with_trigrams=True):
+        """Індексує елемент, повертає слова, які він додав до індексу"""
+        key = id(item)
+        self.items[key] = (kind, item)
+        self.texts[key] = tuple(normalize(field) for field in search_fields(item))
+        words = re.findall(r"\w+", " ".join(self.texts[key]))
+        new_words = []
+        for word in words:
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = {}
+                new_words.append(word)
+                for gram in word_bigrams(word):
+                    self.word_bigrams.setdefault(gram, set()).add(word)
+            posting[key] = posting.get(key, 0) + 1
+        if with_trigrams:
+            for gram in set().union(*map(trigrams, words)):
+                self.trigrams.setdefault(gram, set()).add(key)
+        return new_words
+
+    def remove(self, item):
+        key = id(item)
+        del self.items[key]
+        words = set(re.findall(r"\w+", " ".join(self.texts.pop(key))))
+        for word in words:
+            posting = self.postings[word]
+            del posting[key]
+            if not posting:
+                del self.postings[word]
+                del self.words[bisect_left(self.words, word)]
+                for gram in word_bigrams(word):
+                    words_with_gram = self.word_bigrams[gram]
+                    words_with_gram.discard(word)
+                    if not words_with_gram:
+                        del self.word_bigrams[gram]
+        for gram in set().union(*map(trigrams, words)):
+            posting = self.trigrams[gram]
+            posting.discard(key)
+            if not posting:
+                del self.trigrams[gram]
+
+    def matches(self, token):
+        """Оцінки елементів, що мають слово, яке починається з token"""
+        scores = {}
+        i = bisect_left(self.words, token)
+        while i < len(self.words) and self.words[i].startswith(token):
+            word = self.words[i]
+            posting = self.postings[word]
+            # Рідкісні слова і збіги цілого слова важать більше
+            weight = math.log(1 + len(self.items) / len(posting)) * (2 if word == token else 1)
+            for key, count in posting.items():
+                scores[key] = scores.get(key, 0) + count * weight
+            i += 1
+        return scores
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Пари (вид, елемент), що містять увесь запит будь-де в тексті, категорії чи дедлайні, від найкращих"""
+        phrase = normalize(query)
+        if not phrase:
+            return []
+        tokens = set(re.findall(r"\w+", phrase))
+        
+        # Поле, що містить запит, містить і кожне його слово, тож кандидати мають усі триграми
+        # слів запиту, починаючи з найменшого списку
+        postings = sorted((self.trigrams.get(gram, set()) for token in tokens for gram in trigrams(token)), key=len)
+        if postings:
+            candidates = postings[0].intersection(*postings[1:])
+        else:
+            # Слова коротші за три літери і розділові знаки не мають триграм, перевіряється кожен елемент
+            candidates = self.items
+        
+        # Триграми лише звужують кандидатів, вирішує сам текст
+        texts = self.texts
+        scores = {key: 0 for key in candidates if any(phrase in field for field in texts[key])}
+        if not scores:
+            return []
+        
+        # Збіги цілих слів і їх початків стоять вище за збіги всередині слів
+        for token in tokens:
+            for key, score in self.matches(token).items():
+                if key in scores:
+                    scores[key] += score
+        return [self.items[key] for key in heapq.nlargest(limit, scores, key=scores.get)]
+
+    def similar_words(self, token):
+        """Проіндексовані слова, близькі до token, з їх схожістю від 0 до 1"""
+        similar = {}
+        # Слова, що починаються з token, вважаються близькими
+        i = bisect_left(self.words, token)
+        while i < len(self.words) and self.words[i].startswith(token):
+            similar[self.words[i]] = 1.0 if self.words[i] == token else 0.8
+            i += 1
+        
+        limit = max_typos(token)
+        if not limit:
+            return similar
+        # Кожна описка змінює не більше трьох біграм, тож слова з меншою кількістю спільних не підходять
+        grams = word_bigrams(token)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.word_bigrams.get(gram, ()))
+        for word, count in shared.items():
+            if count >= len(grams) - 3 * limit and word not in similar:
+                distance = edit_distance(token, word, limit)
+                if distance <= limit:
+                    similar[word] = 1 - distance / max(len(token), len(word))
+        return similar
+
+    def fuzzy_search(self, query, limit=FUZZY_SEARCH_LIMIT):
+        """Найкращі пари (вид, елемент) для слів запиту з урахуванням описок і слова, що збіглися"""
+        scores = {}
+        matched_words = set()
+        for token in set(tokenize(query)):
+            best = {}
+            for word, similarity in self.similar_words(token).items():
+                matched_words.add(word)
+                # Елемент оцінюється за своїм найближчим словом до кожного слова запиту
+                for key in self.postings[word]:
+                    if similarity > best.get(key, 0):
+                        best[key] = similarity
+            for key, similarity in best.items():
+                scores[key] = scores.get(key, 0) + similarity
+        return [self.items[key] for key in heapq.nlargest(limit, scores, key=scores.get)], matched_words
+
+# Функції для роботи з даними
+class UserData:
+    """Задачі, нотатки, категорії та статистика одного чату"""
+
+    def __init__(self, chat_id, tasks=None, notes=None, categories=None, statistics=None, seq=0,
+                 next_task_id=None, next_note_id=None):
+        self.chat_id = chat_id
+        # Задачі та нотатки за id, в порядку додавання
+        self.tasks = {task["id"]: task for task in tasks or []}
+        self.notes = {note["id"]: note for note in notes or []}
+        # Id ніколи не використовуються повторно, тож старе посилання не вкаже на новіший елемент
+        self.next_task_id = next_task_id or max(self.tasks, default=0) + 1
+        self.next_note_id = next_note_id or max(self.notes, default=0) + 1
+        # Id нотаток за id задачі, щоб знаходити нотатки задачі без перегляду всіх
+        self.task_notes = {}
+        for note in self.notes.values():
+            self.task_notes.setdefault(note["task_id"], set()).add(note["id"])
+        self.categories = categories if categories is not None else DEFAULT_CATEGORIES.copy()
+        self.statistics = statistics if statistics is not None else {}
+        self.seq = seq  # Останній запис журналу, що вже враховано в цих даних
+        self.journal_size = 0  # Кількість записів журналу після останнього знімка
+        self.version = 0  # Збільшується при кожній зміні, кешовані клавіатури старішої версії застарілі
+        self.keyboards = {}  # Побудовані клавіатури за видом, разом з версією, для якої їх побудовано
+        self.recovered = False  # Завантажено зі старішого покоління знімка, стискається при наступному записі замість пошкоджених
+        self.in_use = 0  # Скільки оновлень зараз обробляється з цими даними, доти вони не вивантажуються
+        self.count_stats()
+        self._search_index = None
+
+    @property
+    def search_index(self):
+        # Будується при першому пошуку, завантаження чату за нього не платить
+        if self._search_index is None:
+            self._search_index = SearchIndex()
+            self._search_index.add_all([("task", task) for task in self.tasks.values()] +
+                                       [("note", note) for note in self.notes.values()])
+        return self._search_index
+
+    def count_stats(self):
+        """Рахує задачі та нотатки для екрана статистики, apply() підтримує лічильники актуальними"""
+        self.active_by_category = Counter()
+        self.completed_by_category = Counter()
+        self.completed_by_month = Counter()
+        self.notes_by_category = Counter()
+        # Індекс дедлайнів: активні задачі з дедлайном, відсортовані за часом
+        self.due_keys = []
+        self.due_tasks = []
+        for task in self.tasks.values():
+            self.count_task(task, 1)
+        for note in self.notes.values():
+            self.notes_by_category[note.get("category", "")] += 1
+
+    def count_task(self, task, delta):
+        if task.get("completed", False):
+            self.completed_by_category[task.get("category", "")] += delta
+            if task.get("completed_at"):
+                self.completed_by_month[task["completed_at"][:7]] += delta
+        else:
+            self.active_by_category[task.get("category", "")] += delta
+            if task.get("due"):
+                if delta > 0:
+                    i = bisect_right(self.due_keys, task["due"])
+                    self.due_keys.insert(i, task["due"])
+                    self.due_tasks.insert(i, task)
+                else:
+                    i = bisect_left(self.due_keys, task["due"])
+                    while self.due_tasks[i] is not task:
+                        i += 1
+                    del self.due_keys[i]
+                    del self.due_tasks[i]
+
+    def due_range(self, start=None, end=None):
+        """Позиції в індексі дедлайнів задач з терміном у [start, end), межі - рядки DUE_FORMAT"""
+        low = bisect_left(self.due_keys, start) if start else 0
+        high = bisect_left(self.due_keys, end) if end else len(self.due_keys)
+        return low, max(low, high)
+
+    def count_due(self, start=None, end=None):
+        low, high = self.due_range(start, end)
+        return high - low
+
+    def tasks_due(self, start=None, end=None):
+        low, high = self.due_range(start, end)
+        return self.due_tasks[low:high]
+
+    def to_dict(self):
+        # Копія, щоб її можна було записати в іншому потоці, поки обробники змінюють дані
+        return {
+            "tasks": [dict(task) for task in self.tasks.values()],
+            "notes": [dict(note) for note in self.notes.values()],
+            "categories": list(self.categories),
+            "statistics": dict(self.statistics),
+            "seq": self.seq,
+            "next_task_id": self.next_task_id,
+            "next_note_id": self.next_note_id,
+            "version": DATA_VERSION
+        }
+
+    def new_task_id(self):
+        self.next_task_id += 1
+        return self.next_task_id - 1
+
+    def new_note_id(self):
+        self.next_note_id += 1
+        return self.next_note_id - 1
+
+    def record_task(self, record):
+        # Записи, створені до появи сталих id, посилаються на задачу за позицією в списку
+        if "task_id" in record:
+            return self.tasks[record["task_id"]]
+        return list(self.tasks.values())[record["task"]]
+
+    def apply(self, record):
+        """Застосовує один запис журналу (одну зміну) до даних"""
+        op = record["op"]
+        self.version += 1
+        index = self._search_index  # Підтримується актуальним, щойно його побудовано
+        if op == "add_task":
+            task = record["task"]
+            if "id" not in task:
+                task["id"] = self.new_task_id()
+            self.next_task_id = max(self.next_task_id, task["id"] + 1)
+            if "due" not in task:
+                task["due"] = normalize_deadline(task["deadline"], task["created"])
+            self.tasks[task["id"]] = task
+            self.count_task(task, 1)
+            if index is not None:
+                index.add("task", task)
+            # Оновлюємо статистику
+            stats_key = f"tasks_{task['created'][:7]}"
+            self.statistics[stats_key] = self.statistics.get(stats_key, 0) + 1
+        elif op == "complete_task":
+            task = self.record_task(record)
+            self.count_task(task, -1)
+            task["completed"] = True
+            task["completed_at"] = record["at"]
+            self.count_task(task, 1)
+        elif op == "reactivate_task":
+            task = self.record_task(record)
+            self.count_task(task, -1)
+            task["completed"] = False
+            task["completed_at"] = None
+            self.count_task(task, 1)
+        elif op == "delete_task":
+            task = self.tasks.pop(self.record_task(record)["id"])
+            self.count_task(task, -1)
+            if index is not None:
+                index.remove(task)
+            # Видаляємо нотатки, пов'язані з цією задачею
+            for note_id in self.task_notes.pop(task["id"], ()):
+                note = self.notes.pop(note_id)
+                self.notes_by_category[note.get("category", "")] -= 1
+                if index is not None:
+                    index.remove(note)
+        elif op == "add_note":
+            note = record["note"]
+            if "id" not in note:
+                # Створено до появи сталих id, task_id - це позиція задачі в списку
+                note["id"] = self.new_note_id()
+                tasks = list(self.tasks.values())
+                note["task_id"] = tasks[note["task_id"]]["id"] if 0 <= note["task_id"] < len(tasks) else None
+            self.next_note_id = max(self.next_note_id, note["id"] + 1)
+            self.notes[note["id"]] = note
+            self.task_notes.setdefault(note["task_id"], set()).add(note["id"])
+            self.notes_by_category[note.get("category", "")] += 1
+            if index is not None:
+                index.add("note", note)
+        elif op == "delete_note":
+            note_id = record["note_id"] if "note_id" in record else list(self.notes)[record["note"]]
+            note = self.notes.pop(note_id)
+            self.task_notes[note["task_id"]].discard(note_id)
+            self.notes_by_category[note.get("category", "")] -= 1
+            if index is not None:
+                index.remove(note)
+        else:
+            raise ValueError(f"Невідомий запис журналу: {op}")
+
+# Завантажені чати за chat id, від найдовше неактивного
+users = OrderedDict()
+
+def get_user_file(chat_id, generation=0):
+    user_file = os.path.join(DATA_DIR, f"{chat_id}.json")
+    return f"{user_file}.{generation}" if generation else user_file
+
+def get_journal_file(chat_id, generation=0):
+    # Журнал покоління містить записи від його знімка до наступного новішого
+    journal_file = os.path.join(DATA_DIR, f"{chat_id}.journal")
+    return f"{journal_file}.{generation}" if generation else journal_file
+
+SNAPSHOT_MAGIC = b"PMSNAP2"
+DATA_VERSION = 3  # Збільшується разом з новим кроком у migrate_data()
+
+# Кодеки знімків: назва -> (кодування, декодування)
+SNAPSHOT_CODECS = {
+    "json": (lambda data: json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8'), json.loads),
+    # Без відступів і пробілів, на випадок, коли не встановлено ні orjson, ні msgpack
+    "json-min": (lambda data: json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode('utf-8'), json.loads),
+}
+if orjson is not None:
+    SNAPSHOT_CODECS["orjson"] = (orjson.dumps, orjson.loads)
+if msgpack is not None:
+    SNAPSHOT_CODECS["msgpack"] = (msgpack.packb, msgpack.unpackb)
+
+# Найшвидший встановлений кодек, якщо не потрібні читабельні знімки
+SNAPSHOT_CODEC = "json" if SNAPSHOT_FORMAT == "json" else next(
+    name for name in ("orjson", "msgpack", "json-min") if name in SNAPSHOT_CODECS
+)
+
+def write_snapshot(path, data):
+    """Записує дані у файл після заголовка з кодеком і контрольною сумою та скидає їх на диск"""
+    body = SNAPSHOT_CODECS[SNAPSHOT_CODEC][0](data)
+    header = SNAPSHOT_MAGIC + f" {SNAPSHOT_CODEC} {hashlib.sha256(body).hexdigest()} {len(body)}\n".encode()
+    with open(path, 'wb') as f:
+        f.write(header + body)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(header) + len(body)
+
+def read_snapshot(path):
+    with open(path, 'rb') as f:
+        content = f.read()
+    
+    # Файли, записані до появи контрольних сум, - це звичайний JSON
+    if not content.startswith(b"PMSNAP"):
+        return json.loads(content)
+    
+    header, _, content = content.partition(b"\n")
+    fields = header.decode().split()
+    # Заголовки PMSNAP1 не мали кодека, такі знімки - це JSON
+    _, codec, checksum, length = fields if len(fields) == 4 else (fields[0], "json", *fields[1:])
+    if len(content) != int(length) or hashlib.sha256(content).hexdigest() != checksum:
+        raise ValueError("checksum mismatch")
+    # Розпакування pickle може виконати будь-який код, тому pickle-знімки старіших версій не читаються
+    if codec == "pickle":
+        raise ValueError("pickle-знімки більше не читаються")
+    if codec not in SNAPSHOT_CODECS:
+        raise ValueError(f"кодек знімка {codec} не встановлено")
+    return SNAPSHOT_CODECS[codec][1](content)
+
+def fsync_dir(path):
+    # Робить перейменування надійним; на Windows каталоги не відкриваються
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def migrate_data(data):
+    # Міграція старих даних
+    if isinstance(data.get("tasks", []), list) and len(data.get("tasks", [])) > 0 and isinstance(data["tasks"][0], str):
+        data["tasks"] = [{
+            "text": task.split(" — ")[0], 
+            "deadline": task.split(" — ")[1] if " — " in task else "", 
+            "category": "", 
+            "created": str(datetime.now()),
+            "completed": False,
+            "completed_at": None
+        } for task in data.get("tasks", [])]
+    
+    # Перевірка наявності всіх необхідних полів
+    for task in data.get("tasks", []):
+        task.setdefault("completed", False)
+        task.setdefault("completed_at", None)
+        task.setdefault("created", str(datetime.now()))
+    
+    # Версія 2: дедлайни розбираються один раз і зберігаються нормалізованими
+    for task in data.get("tasks", []):
+        if "due" not in task:
+            task["due"] = normalize_deadline(task.get("deadline", ""), task["created"])
+    
+    # Версія 3: сталі id, нотатки посилаються на id задачі замість її позиції в списку
+    tasks = data.get("tasks", [])
+    for i, task in enumerate(tasks, 1):
+        task.setdefault("id", i)
+    for i, note in enumerate(data.get("notes", []), 1):
+        if "id" not in note:
+            note["id"] = i
+            position = note.get("task_id", 0)
+            note["task_id"] = tasks[position]["id"] if 0 <= position < len(tasks) else None
+
+def read_data_file(path):
+    data = read_snapshot(path)
+    # Знімки, записані цією версією, вже мігровані
+    if data.get("version", 0) < DATA_VERSION:
+        migrate_data(data)
+    
+    return {
+        "tasks": data.get("tasks", []),
+        "notes": data.get("notes", []),
+        "categories": data.get("categories", DEFAULT_CATEGORIES.copy()),
+        "statistics": data.get("statistics", {}),
+        "seq": data.get("seq", 0),
+        "next_task_id": data.get("next_task_id"),
+        "next_note_id": data.get("next_note_id")
+    }
+
+class JsonStorage:
+    """Зберігає кожен чат у DATA_DIR як файл знімка і JSON-журнал пізніших змін"""
+
+    compact_every = JOURNAL_COMPACT_EVERY
+
+    def chat_ids(self):
+        chat_ids = set()
+        for name in os.listdir(DATA_DIR):
+            chat_id, _, ext = name.partition(".")
+            if ext.startswith(("json", "journal")) and chat_id.lstrip("-").isdigit():
+                chat_ids.add(int(chat_id))
+        return sorted(chat_ids)
+
+    def count_items(self, share=None):
+        # Підрахунок означав би читання знімка кожного чату, рахуються лише завантажені чати
+        return None
+
+    def load(self, chat_id):
+        """Завантажує найновіший цілий знімок даних чату і доповнює його журналами, записаними після нього"""
+        user_data = UserData(chat_id)
+        generation = SNAPSHOT_GENERATIONS - 1
+        damaged_files = []
+        for snapshot_generation in range(SNAPSHOT_GENERATIONS):
+            user_file = get_user_file(chat_id, snapshot_generation)
+            if not os.path.exists(user_file):
+                continue
+            try:
+                user_data = UserData(chat_id, **read_data_file(user_file))
+                generation = snapshot_generation
+                break
+            except (ValueError, KeyError, AttributeError, OSError) as e:
+                logger.error(f"Помилка завантаження {user_file}: {e}, пробуємо старіший знімок")
+                damaged_files.append(user_file)
+        else:
+            # Порожні дані сховали б задачі чату, а стискання витіснило б його файли
+            if damaged_files:
+                raise ValueError(f"жоден знімок чату {chat_id} не читається, його файли залишено як є")
+        
+        # Пошкоджені знімки відкладаються для перевірки, тож стискання обертає лише цілі
+        for user_file in damaged_files:
+            os.replace(user_file, user_file + ".damaged")
+        user_data.recovered = bool(damaged_files)
+        self.replay_journals(user_data, generation)
+        if user_data.recovered:
+            logger.error(f"Чат {chat_id} відновлено зі старішого знімка, пошкоджені збережено як файли .damaged")
+        return user_data
+
+    def replay_journals(self, user_data, generation):
+        """Відтворює журнали від журналу завантаженого покоління до поточного"""
+        for journal_generation in range(generation, -1, -1):
+            journal_file = get_journal_file(user_data.chat_id, journal_generation)
+            if not os.path.exists(journal_file):
+                continue
+            valid_size = self.replay_journal(user_data, journal_file)
+            if valid_size is None:
+                continue
             
-            return {
-                "tasks": data.get("tasks", []),
-                "notes": data.get("notes", []),
-                "categories": data.get("categories", DEFAULT_CATEGORIES.copy()),
-                "statistics": data.get("statistics", {})
-            }
-    except (json.JSONDecodeError, KeyError, AttributeError) as e:
-        logger.error(f"Помилка завантаження даних: {e}, повертаються дані за замовчуванням")
-        return default_data
-
-def save_data(data):
+            # Нові записи мають іти після останнього цілого: журнал обрізається там, а новіші
+            # журнали, які після пропуску не відтворити, відкладаються для перевірки
+            shutil.copyfile(journal_file, journal_file + ".broken")
+            with open(journal_file, 'r+b') as f:
+                f.truncate(valid_size)
+            for newer_generation in range(journal_generation - 1, -1, -1):
+                newer_file = get_journal_file(user_data.chat_id, newer_generation)
+                if os.path.exists(newer_file):
+                    os.replace(newer_file, newer_file + ".broken")
+            return
+
+    def replay_journal(self, user_data, journal_file):
+        """Застосовує записи журналу, яких ще немає в даних, повертає None або розмір цілої частини пошкодженого журналу"""
+        valid_size = 0
+        try:
+            with open(journal_file, 'rb') as f:
+                for line in f:
+                    # Запису, обірваному збоєм, не довіряємо, навіть якщо він розбирається
+                    if not line.endswith(b"\n"):
+                        raise ValueError("останній запис неповний")
+                    record = json.loads(line)
+                    # Записи до seq вже є у знімку
+                    if record["seq"] > user_data.seq:
+                        # Журнал продовжує новіший знімок, ніж завантажений
+                        if record["seq"] != user_data.seq + 1:
+                            raise ValueError(f"бракує записів {user_data.seq + 1}-{record['seq'] - 1}")
+                        user_data.apply(record)
+                        user_data.seq = record["seq"]
+                        user_data.journal_size += 1
+                    valid_size += len(line)
+            return None
+        except (json.JSONDecodeError, KeyError, IndexError, ValueError, OSError) as e:
+            logger.error(f"Помилка відтворення журналу {journal_file}: {e}, решту пропущено")
+            return valid_size
+
+    def save(self, chat_id, data):
+        """Записує нове покоління знімка даних чату і починає новий журнал, повертає кількість записаних байтів або False"""
+        user_file = get_user_file(chat_id)
+        tmp_file = user_file + ".tmp"
+        try:
+            written = write_snapshot(tmp_file, data)
+            # Зберігаємо старіші покоління на випадок пошкодження найновішого, кожне з журналом,
+            # що доповнює його до наступного
+            for generation in range(SNAPSHOT_GENERATIONS - 1, 0, -1):
+                for get_file in (get_user_file, get_journal_file):
+                    older_file, newer_file = get_file(chat_id, generation - 1), get_file(chat_id, generation)
+                    if os.path.exists(older_file):
+                        os.replace(older_file, newer_file)
+                    elif os.path.exists(newer_file):
+                        os.remove(newer_file)
+            os.replace(tmp_file, user_file)
+            fsync_dir(DATA_DIR)
+        except Exception as e:
+            logger.error(f"Помилка збереження даних: {e}")
+            return False
+        return written
+
+    def write_changes(self, chat_id, records, snapshot=None):
+        written = 0
+        try:
+            with open(get_journal_file(chat_id), 'ab') as f:
+                written = f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8"))
+        except Exception as e:
+            logger.error(f"Помилка запису журналу: {e}")
+        
+        # Стискаємо журнал у новий знімок; журнал теж зберігає ці записи, тож попередній знімок
+        # усе ще можна доповнити до цього
+        if snapshot is not None:
+            written += self.save(chat_id, snapshot) or 0
+        return written
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    next_task_id INTEGER NOT NULL DEFAULT 1,
+    next_note_id INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    number INTEGER,
+    text TEXT NOT NULL,
+    deadline TEXT NOT NULL DEFAULT '',
+    category TEXT NOT NULL DEFAULT '',
+    created TEXT NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    completed_at TEXT,
+    due TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_user_completed ON tasks (user_id, completed);
+CREATE INDEX IF NOT EXISTS tasks_user_deadline ON tasks (user_id, deadline);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    number INTEGER,
+    task_id INTEGER,
+    text TEXT NOT NULL,
+    category TEXT NOT NULL DEFAULT '',
+    created TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notes_user_task ON notes (user_id, task_id);
+CREATE TABLE IF NOT EXISTS categories (
+    user_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (user_id, position)
+);
+CREATE TABLE IF NOT EXISTS statistics (
+    user_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, key)
+);
+"""
+
+class SQLiteStorage:
+    """Зберігає всі чати в одній базі SQLite, тож зміна зачіпає лише свої рядки"""
+
+    compact_every = 0  # Кожна зміна є окремою транзакцією, стискати нічого
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        # Бази, створені до нормалізації дедлайнів, не мають колонки due
+        if "due" not in [column[1] for column in self.conn.execute("PRAGMA table_info(tasks)")]:
+            with self.conn:
+                self.conn.execute("ALTER TABLE tasks ADD COLUMN due TEXT")
+                self.conn.executemany("UPDATE tasks SET due = ? WHERE id = ?", [
+                    (normalize_deadline(deadline, created), task_id) for task_id, deadline, created in
+                    self.conn.execute("SELECT id, deadline, created FROM tasks WHERE deadline != ''").fetchall()
+                ])
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_user_due ON tasks (user_id, completed, due)")
+        # До сталих id задачі й нотатки нумерувались за позицією, а notes.task_id був позицією задачі
+        if "number" not in [column[1] for column in self.conn.execute("PRAGMA table_info(tasks)")]:
+            with self.conn:
+                self.conn.execute("ALTER TABLE tasks ADD COLUMN number INTEGER")
+                self.conn.execute("ALTER TABLE notes ADD COLUMN number INTEGER")
+                self.conn.execute("ALTER TABLE users ADD COLUMN next_task_id INTEGER NOT NULL DEFAULT 1")
+                self.conn.execute("ALTER TABLE users ADD COLUMN next_note_id INTEGER NOT NULL DEFAULT 1")
+                for table in ("tasks", "notes"):
+                    self.conn.execute(
+                        f"UPDATE {table} SET number = "
+                        f"(SELECT COUNT(*) FROM {table} AS earlier WHERE earlier.user_id = {table}.user_id AND earlier.id <= {table}.id)"
+                    )
+                self.conn.execute("UPDATE notes SET task_id = task_id + 1")
+                self.conn.execute(
+                    "UPDATE users SET "
+                    "next_task_id = (SELECT COALESCE(MAX(number), 0) + 1 FROM tasks WHERE tasks.user_id = users.user_id), "
+                    "next_note_id = (SELECT COALESCE(MAX(number), 0) + 1 FROM notes WHERE notes.user_id = users.user_id)"
+                )
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tasks_user_number ON tasks (user_id, number)")
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS notes_user_number ON notes (user_id, number)")
+
+    def chat_ids(self):
+        return [user_id for (user_id,) in self.conn.execute("SELECT user_id FROM users ORDER BY user_id")]
+
+    def count_items(self, share=None):
+        """Кількість задач і нотаток усіх чатів або чатів частки (workers, index)"""
+        where, args = "", ()
+        if share is not None:
+            # Остача як у Python, як у handles_chat, id групових чатів від'ємні
+            workers, index = share
+            where, args = " WHERE ((user_id % ?) + ?) % ? = ?", (workers, workers, workers, index)
+        return tuple(
+            self.conn.execute(f"SELECT COUNT(*) FROM {table}{where}", args).fetchone()[0] for table in ("tasks", "notes")
+        )
+
+    def load(self, chat_id):
+        tasks = [{
+            "id": number,
+            "text": text,
+            "deadline": deadline,
+            "category": category,
+            "created": created,
+            "completed": bool(completed),
+            "completed_at": completed_at,
+            "due": due
+        } for number, text, deadline, category, created, completed, completed_at, due in self.conn.execute(
+            "SELECT number, text, deadline, category, created, completed, completed_at, due "
+            "FROM tasks WHERE user_id = ? ORDER BY id", (chat_id,)
+        )]
+        notes = [{
+            "id": number,
+            "text": text,
+            "task_id": task_id,
+            "category": category,
+            "created": created
+        } for number, text, task_id, category, created in self.conn.execute(
+            "SELECT number, text, task_id, category, created FROM notes WHERE user_id = ? ORDER BY id", (chat_id,)
+        )]
+        categories = [name for (name,) in self.conn.execute(
+            "SELECT name FROM categories WHERE user_id = ? ORDER BY position", (chat_id,)
+        )]
+        statistics = dict(self.conn.execute("SELECT key, value FROM statistics WHERE user_id = ?", (chat_id,)))
+        next_ids = self.conn.execute(
+            "SELECT next_task_id, next_note_id FROM users WHERE user_id = ?", (chat_id,)
+        ).fetchone() or (None, None)
+        return UserData(chat_id, tasks, notes, categories or None, statistics, 0, *next_ids)
+
+    def save(self, chat_id, data):
+        """Замінює всі рядки чату переданими даними"""
+        with self.conn:
+            for table in ("tasks", "notes", "categories", "statistics"):
+                self.conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (chat_id,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO users (user_id, next_task_id, next_note_id) VALUES (?, ?, ?)",
+                (chat_id, data["next_task_id"], data["next_note_id"])
+            )
+            self.conn.executemany(
+                "INSERT INTO tasks (user_id, number, text, deadline, category, created, completed, completed_at, due) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(chat_id, task["id"], task["text"], task.get("deadline", ""), task.get("category", ""), task["created"],
+                  task.get("completed", False), task.get("completed_at"), task.get("due")) for task in data["tasks"]]
+            )
+            self.conn.executemany(
+                "INSERT INTO notes (user_id, number, task_id, text, category, created) VALUES (?, ?, ?, ?, ?, ?)",
+                [(chat_id, note["id"], note.get("task_id"), note["text"], note.get("category", ""), note["created"])
+                 for note in data["notes"]]
+            )
+            self.conn.executemany(
+                "INSERT INTO categories (user_id, position, name) VALUES (?, ?, ?)",
+                [(chat_id, i, name) for i, name in enumerate(data["categories"])]
+            )
+            self.conn.executemany(
+                "INSERT INTO statistics (user_id, key, value) VALUES (?, ?, ?)",
+                [(chat_id, key, value) for key, value in data["statistics"].items()]
+            )
+
+    def write_changes(self, chat_id, records, snapshot=None):
+        # Усі зміни пакета йдуть однією транзакцією
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (chat_id,))
+            for record in records:
+                self.write_change(chat_id, record)
+
+    def write_change(self, chat_id, record):
+        op = record["op"]
+        if op == "add_task":
+            task = record["task"]
+            self.conn.execute(
+                "INSERT INTO tasks (user_id, number, text, deadline, category, created, completed, completed_at, due) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (chat_id, task["id"], task["text"], task["deadline"], task["category"], task["created"],
+                 task["completed"], task["completed_at"], task["due"])
+            )
+            self.conn.execute(
+                "UPDATE users SET next_task_id = MAX(next_task_id, ?) WHERE user_id = ?", (task["id"] + 1, chat_id)
+            )
+            self.conn.execute(
+                "INSERT INTO statistics (user_id, key, value) VALUES (?, ?, 1) "
+                "ON CONFLICT (user_id, key) DO UPDATE SET value = value + 1",
+                (chat_id, f"tasks_{task['created'][:7]}")
+            )
+        elif op == "complete_task":
+            self.conn.execute(
+                "UPDATE tasks SET completed = 1, completed_at = ? WHERE user_id = ? AND number = ?",
+                (record["at"], chat_id, record["task_id"])
+            )
+        elif op == "reactivate_task":
+            self.conn.execute(
+                "UPDATE tasks SET completed = 0, completed_at = NULL WHERE user_id = ? AND number = ?",
+                (chat_id, record["task_id"])
+            )
+        elif op == "delete_task":
+            self.conn.execute("DELETE FROM tasks WHERE user_id = ? AND number = ?", (chat_id, record["task_id"]))
+            self.conn.execute("DELETE FROM notes WHERE user_id = ? AND task_id = ?", (chat_id, record["task_id"]))
+        elif op == "add_note":
+            note = record["note"]
+            self.conn.execute(
+                "INSERT INTO notes (user_id, number, task_id, text, category, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, note["id"], note["task_id"], note["text"], note["category"], note["created"])
+            )
+            self.conn.execute(
+                "UPDATE users SET next_note_id = MAX(next_note_id, ?) WHERE user_id = ?", (note["id"] + 1, chat_id)
+            )
+        elif op == "delete_note":
+            self.conn.execute("DELETE FROM notes WHERE user_id = ? AND number = ?", (chat_id, record["note_id"]))
+        else:
+            raise ValueError(f"Невідомий запис журналу: {op}")
+
+    def import_json_data(self):
+        """Копіює в базу чати, що існують лише як файли в DATA_DIR"""
+        known_chats = set(self.chat_ids())
+        json_storage = JsonStorage()
+        for chat_id in json_storage.chat_ids():
+            if chat_id not in known_chats:
+                try:
+                    self.save(chat_id, json_storage.load(chat_id).to_dict())
+                except ValueError as e:
+                    logger.error(f"Чат {chat_id} не імпортовано: {e}")
+                    continue
+                logger.info(f"Чат {chat_id} імпортовано в {SQLITE_FILE}")
+
+# Задача може мати по одному нагадуванню кожного виду: на дедлайн і встановлене користувачем
+REMINDER_KINDS = ("deadline", "custom")
+REMINDERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reminders (
+    chat_id INTEGER NOT NULL,
+    task_id INTEGER NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'deadline',
+    fire_at TEXT NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (chat_id, task_id, kind)
+);
+CREATE INDEX IF NOT EXISTS reminders_fire_at ON reminders (fire_at);
+"""
+
+class ReminderStore:
+    """Нагадування, що чекають на відправку, по одному на задачу і вид, щоб вони переживали перезапуск"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Нове сховище треба один раз заповнити з дедлайнів задач
+        self.created = not self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'reminders'"
+        ).fetchone()
+        columns = [column[1] for column in self.conn.execute("PRAGMA table_info(reminders)")]
+        if columns and "kind" not in columns:
+            # Сховища, створені до видів нагадувань, мали одне на задачу, воно стає нагадуванням на дедлайн
+            self.conn.executescript(
+                "BEGIN;"
+                "DROP INDEX IF EXISTS reminders_fire_at;"
+                "ALTER TABLE reminders RENAME TO reminders_by_task;"
+                + REMINDERS_SCHEMA +
+                "INSERT INTO reminders (chat_id, task_id, kind, fire_at, text) "
+                "SELECT chat_id, task_id, 'deadline', fire_at, text FROM reminders_by_task;"
+                "DROP TABLE reminders_by_task;"
+                "COMMIT;"
+            )
+        self.conn.executescript(REMINDERS_SCHEMA)
+
+    def set(self, chat_id, task_id, kind, fire_at, text):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO reminders (chat_id, task_id, kind, fire_at, text) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, task_id, kind, fire_at, text)
+            )
+
+    def remove(self, chat_id, task_id, kind=None):
+        """Видаляє нагадування задачі вказаного виду або всі"""
+        with self.conn:
+            if kind is None:
+                self.conn.execute("DELETE FROM reminders WHERE chat_id = ? AND task_id = ?", (chat_id, task_id))
+            else:
+                self.conn.execute(
+                    "DELETE FROM reminders WHERE chat_id = ? AND task_id = ? AND kind = ?", (chat_id, task_id, kind)
+                )
+
+    def pending(self, missed_since):
+        """Нагадування, які ще треба надіслати, прострочені першими; ті, що мали бути до missed_since, відкидаються"""
+        with self.conn:
+            self.conn.execute("DELETE FROM reminders WHERE fire_at < ?", (missed_since,))
+        return self.conn.execute("SELECT chat_id, task_id, kind, fire_at, text FROM reminders ORDER BY fire_at").fetchall()
+
+storage = SQLiteStorage(SQLITE_FILE) if STORAGE_BACKEND == "sqlite" else JsonStorage()
+reminders = ReminderStore(REMINDERS_FILE)
+
+class ReminderQueue:
+    """Надсилає нагадування з однієї задачі, яка спить до найближчого з них
+
+    Нагадування зберігаються в мін-купі за часом спрацювання, тож додавання коштує O(log n).
+    Скасоване нагадування лише позначається і пропускається, коли опиняється на вершині,
+    а купа перебудовується, коли скасовані записи складають більшу її частину.
+    """
+
+    def __init__(self):
+        self.heap = []  # [час спрацювання, порядок додавання, id чату, id задачі, вид, текст або None, якщо скасовано]
+        self.entries = {}  # (chat_id, task_id, kind) -> її запис у купі
+        self.cancelled = 0
+        self.added = 0
+        self.wakeup = asyncio.Event()
+        self.sending = set()
+        self._task = None
+
+    def add(self, chat_id, task_id, kind, fire_at, text):
+        """Планує нагадування задачі замість попереднього того ж виду"""
+        self.cancel(chat_id, task_id, kind)
+        self.added += 1
+        entry = [fire_at.timestamp(), self.added, chat_id, task_id, kind, text]
+        self.entries[(chat_id, task_id, kind)] = entry
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self.wakeup.set()
+
+    def cancel(self, chat_id, task_id, kind):
+        entry = self.entries.pop((chat_id, task_id, kind), None)
+        if entry is None:
+            return
+        entry[-1] = None
+        self.cancelled += 1
+        if self.cancelled > len(self.heap) // 2:
+            self.heap = [entry for entry in self.heap if entry[-1] is not None]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def run(self):
+        while True:
+            while self.heap and self.heap[0][-1] is None:
+                heapq.heappop(self.heap)
+                self.cancelled -= 1
+            delay = self.heap[0][0] - time.time() if self.heap else None
+            if delay is None or delay > 0:
+                # Прокидається раніше, якщо додано нагадування перед найближчим
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            fire_at, _, chat_id, task_id, kind, text = heapq.heappop(self.heap)
+            del self.entries[(chat_id, task_id, kind)]
+            sending = asyncio.get_running_loop().create_task(send_reminder(chat_id, task_id, kind, text, fire_at))
+            self.sending.add(sending)
+            sending.add_done_callback(self.sending.discard)
+
+reminder_queue = ReminderQueue()
+# Виклики сховища виконуються по одному, в порядку надходження
+storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+def run_in_storage(func, *args):
+    # Ставиться в чергу одразу, повернений future можна дочекатися пізніше
+    return asyncio.get_running_loop().run_in_executor(storage_executor, func, *args)
+
+def load_data(chat_id):
+    return storage.load(chat_id)
+
+def save_data(user_data):
+    timed_save(storage.save, user_data.chat_id, user_data.to_dict())
+
+def timed_save(write, *args):
+    """Виконує запис у сховище, фіксуючи скільки він тривав і скільки записав"""
+    started = time.perf_counter()
+    written = write(*args)
+    save_seconds.observe(time.perf_counter() - started)
+    if written:
+        save_bytes.observe(written)
+    return written
+
+# Зміни, що чекають на запис, за chat id
+pending_changes = {}
+_flush_task = None
+_flush_lock = asyncio.Lock()
+
+def commit_change(user_data, record):
+    """Застосовує зміну до даних чату і ставить її в чергу на наступний запис на диск"""
+    global _flush_task
+    user_data.apply(record)
+    user_data.seq += 1
+    record["seq"] = user_data.seq
+    pending_changes.setdefault(user_data.chat_id, []).append(record)
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.get_running_loop().create_task(flush_changes(SAVE_DELAY))
+
+def write_changes(user_data, records, compact=False):
+    """Ставить записи чату в чергу потоку сховища, зі знімком, коли журнал час стиснути"""
+    snapshot = None
+    user_data.journal_size += len(records)
+    # Відновлений чат одразу знову отримує цілий найновіший знімок
+    if storage.compact_every and (compact or user_data.recovered or user_data.journal_size >= storage.compact_every):
+        snapshot = user_data.to_dict()
+        user_data.journal_size = 0
+        user_data.recovered = False
+    return run_in_storage(timed_save, storage.write_changes, user_data.chat_id, records, snapshot)
+
+async def wait_for_write(chat_id, write):
     try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        await write
     except Exception as e:
-        logger.error(f"Помилка збереження даних: {e}")
-        # Додаткова обробка помилок
+        logger.error(f"Помилка збереження даних чату {chat_id}: {e}")
+
+async def flush_changes(delay=0):
+    """Записує всі зміни з черги, одним пакетом на чат, у потоці сховища"""
+    await asyncio.sleep(delay)
+    async with _flush_lock:
+        while pending_changes:
+            batch = dict(pending_changes)
+            pending_changes.clear()
+            # Ставляться в чергу всі одразу, тож чат, завантажений пізніше, читається після своїх записів
+            writes = [(chat_id, write_changes(users[chat_id], records)) for chat_id, records in batch.items()]
+            for chat_id, write in writes:
+                await wait_for_write(chat_id, write)
+
+def unload_inactive_users():
+    """Вивантажує найдовше неактивні чати понад MAX_LOADED_USERS, спершу записуючи їх незбережені зміни"""
+    for chat_id in list(users):
+        if len(users) <= MAX_LOADED_USERS:
+            break
+        user_data = users[chat_id]
+        if user_data.in_use:
+            continue
+        del users[chat_id]
+        records = pending_changes.pop(chat_id, None)
+        if records:
+            write = write_changes(user_data, records, compact=True)
+            asyncio.get_running_loop().create_task(wait_for_write(chat_id, write))
+
+async def get_user_data(chat_id):
+    user_data = users.get(chat_id)
+    if user_data is None:
+        loaded = await run_in_storage(load_data, chat_id)
+        # Інше оновлення з цього чату могло тим часом завантажити дані
+        user_data = users.setdefault(chat_id, loaded)
+        unload_inactive_users()
+    users.move_to_end(chat_id)
+    return user_data
+
+def migrate_legacy_data():
+    """Переносить задачі зі старого спільного DATA_FILE у дані чату LEGACY_DATA_OWNER"""
+    if not os.path.exists(DATA_FILE):
+        return
+    if LEGACY_DATA_OWNER is None:
+        logger.warning(f"Знайдено {DATA_FILE}, вкажіть LEGACY_DATA_OWNER для його міграції")
+        return
+    if LEGACY_DATA_OWNER in storage.chat_ids():
+        logger.warning(f"Чат {LEGACY_DATA_OWNER} вже має дані, {DATA_FILE} не перенесено")
+        return
+    
+    try:
+        save_data(UserData(LEGACY_DATA_OWNER, **read_data_file(DATA_FILE)))
+        os.replace(DATA_FILE, DATA_FILE + ".migrated")
+        logger.info(f"{DATA_FILE} перенесено до чату {LEGACY_DATA_OWNER}")
+    except (json.JSONDecodeError, KeyError, AttributeError, OSError) as e:
+        logger.error(f"Помилка міграції даних: {e}")
+
+class UserDataMiddleware(BaseMiddleware):
+    """Передає обробникам дані чату, з якого прийшло оновлення, як `user_data`"""
+
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        if chat is None:
+            return await handler(event, data)
+        
+        user_data = data["user_data"] = await get_user_data(chat.id)
+        user_data.in_use += 1
         try:
-            # Спробуємо зберегти резервну копію
-            with open(DATA_FILE + ".backup", 'w', encoding='utf-8') as f_backup:
-                json.dump(data, f_backup, ensure_ascii=False, indent=2)
-            logger.info("Створено резервну копію даних")
-        except Exception as backup_e:
-            logger.error(f"Помилка створення резервної копії: {backup_e}")
+            return await handler(event, data)
+        finally:
+            user_data.in_use -= 1
+
+class TokenBucket:
+    """Дозволяє в середньому `rate` запитів на секунду і до `capacity` одразу"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Бере токен, повертає скільки секунд чекати перед його використанням"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        # Нижче нуля токен позичається з майбутнього, запити стають у чергу по порядку
+        return max(0.0, -self.tokens / self.rate)
+
+    def idle(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Обмежує кожен запит, що надсилає щось у чат, згідно з лімітами Telegram
+
+    Запит чекає на токен із загального відра і з відра свого чату. Якщо Telegram все одно
+    відповідає retry_after, усі надсилання призупиняються на цей час, а запит повторюється.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_RATE)
+        self.chat_buckets = {}
+        self.paused_until = 0.0
+        # Метрики
+        self.waiting = 0  # Запитів, що чекають своєї черги
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_LOADED_USERS:
+                self.chat_buckets = {chat: bucket for chat, bucket in self.chat_buckets.items() if not bucket.idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(CHAT_SEND_RATE, CHAT_SEND_BURST)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getUpdates, answerCallbackQuery тощо не мають обмеження на надсилання
+            return await self.timed_request(make_request, bot, method)
+        
+        queued = time.monotonic()
+        self.waiting += 1
+        try:
+            for attempt in range(MAX_SEND_RETRIES + 1):
+                delay = max(self.global_bucket.reserve(), self.chat_bucket(chat_id).reserve(),
+                            self.paused_until - time.monotonic())
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                started = time.monotonic()
+                try:
+                    response = await self.timed_request(make_request, bot, method)
+                except TelegramRetryAfter as e:
+                    if attempt == MAX_SEND_RETRIES:
+                        self.failed += 1
+                        raise
+                    self.retries += 1
+                    self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                    logger.warning(f"Telegram попросив зачекати {e.retry_after} с перед {type(method).__name__}, повторюємо")
+                    continue
+                self.sent += 1
+                outbound_wait_seconds.observe(started - queued)
+                return response
+        finally:
+            self.waiting -= 1
+
+    async def timed_request(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            bot_api_seconds.observe(time.perf_counter() - started, method.__api_method__)
+
+    def metrics(self):
+        return {
+            "queue_depth": self.waiting,
+            "sent": self.sent,
+            "retries": self.retries,
+            "failed": self.failed,
+        }
+
+outbound_limiter = OutboundLimiter()
+
+class UpdateTimer(BaseMiddleware):
+    """Вимірює повний час обробки кожного оновлення і записує повільні в журнал повільних"""
+
+    async def __call__(self, handler, event, data):
+        timing = data["update_timing"] = {"handler": None}
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            update_seconds.observe(elapsed, event.event_type)
+            if elapsed >= SLOW_UPDATE_SECONDS:
+                chat = data.get("event_chat")
+                slow_log.warning(json.dumps({
+                    "update_id": event.update_id,
+                    "type": event.event_type,
+                    "chat_id": chat.id if chat else None,
+                    "handler": timing["handler"],
+                    "state": data.get("raw_state"),
+                    "seconds": round(elapsed, 3),
+                }, ensure_ascii=False))
+
+class HandlerTimer(BaseMiddleware):
+    """Фіксує, скільки триває кожен обробник, за назвою обробника"""
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        # Повідомляє UpdateTimer, якому обробнику відповідало оновлення
+        if "update_timing" in data:
+            data["update_timing"]["handler"] = name
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
 
 # Завантаження даних
-data = load_data()
-tasks = data.get("tasks", [])
-notes = data.get("notes", [])
-categories = data.get("categories", DEFAULT_CATEGORIES.copy())
-statistics = data.get("statistics", {})
+if STORAGE_BACKEND == "sqlite":
+    storage.import_json_data()
+migrate_legacy_data()
+dp.update.outer_middleware(UpdateTimer())
+dp.update.outer_middleware(UserDataMiddleware())
+dp.message.middleware(HandlerTimer())
+dp.callback_query.middleware(HandlerTimer())
+bot.session.middleware(outbound_limiter)
 
 # Клавіатури (кешовані версії)
 _main_menu_kb = None
@@ -197,18 +1712,31 @@ def get_back_kb():
         _back_kb = builder.as_markup(resize_keyboard=True)
     return _back_kb
 
-def get_tasks_kb(completed=False):
+def cached_kb(user_data, view, build):
+    """Повертає клавіатуру чату для виду, перебудовану лише після зміни даних"""
+    cached = user_data.keyboards.get(view)
+    if cached is None or cached[0] != user_data.version:
+        cached = user_data.keyboards[view] = (user_data.version, build())
+    return cached[1]
+
+def get_tasks_kb(user_data, completed=False):
+    return cached_kb(user_data, ("tasks", completed), lambda: build_tasks_kb(user_data, completed))
+
+def build_tasks_kb(user_data, completed):
     builder = ReplyKeyboardBuilder()
-    for i, task in enumerate(tasks):
+    for task in user_data.tasks.values():
         if task.get("completed", False) == completed:
-            builder.add(types.KeyboardButton(text=f"{i+1}. {task['text']}"))
+            builder.add(types.KeyboardButton(text=f"{task['id']}. {task['text']}"))
     builder.add(types.KeyboardButton(text="◀️ Назад"))
     builder.adjust(1)
     return builder.as_markup(resize_keyboard=True)
 
-def get_categories_kb():
+def get_categories_kb(user_data):
+    return cached_kb(user_data, "categories", lambda: build_categories_kb(user_data))
+
+def build_categories_kb(user_data):
     builder = ReplyKeyboardBuilder()
-    for category in categories:
+    for category in user_data.categories:
         builder.add(types.KeyboardButton(text=category))
     builder.add(types.KeyboardButton(text="◀️ Назад"))
     builder.adjust(2)
@@ -222,15 +1750,57 @@ def get_export_kb():
     builder.adjust(3)
     return builder.as_markup()
 
-def get_tasks_for_notes_kb():
+def get_tasks_for_notes_kb(user_data):
+    return cached_kb(user_data, "tasks_for_notes", lambda: build_tasks_for_notes_kb(user_data))
+
+def build_tasks_for_notes_kb(user_data):
     builder = ReplyKeyboardBuilder()
-    for i, task in enumerate(tasks):
+    for task in user_data.tasks.values():
         if not task.get("completed", False):
-            builder.add(types.KeyboardButton(text=f"{i+1}. {task['text']}"))
+            builder.add(types.KeyboardButton(text=f"{task['id']}. {task['text']}"))
     builder.add(types.KeyboardButton(text="◀️ Назад"))
     builder.adjust(1)
     return builder.as_markup(resize_keyboard=True)
 
+def get_page_kb(view, page, pages):
+    builder = InlineKeyboardBuilder()
+    if page > 0:
+        builder.add(types.InlineKeyboardButton(text="◀", callback_data=f"page:{view}:{page - 1}"))
+    if page < pages - 1:
+        builder.add(types.InlineKeyboardButton(text="▶", callback_data=f"page:{view}:{page + 1}"))
+    return builder.as_markup()
+
+# Довгі відповіді
+def split_message(text, limit=MESSAGE_LIMIT):
+    """Розбиває текст на частини до `limit` символів, по можливості між рядками"""
+    chunks = []
+    lines = []
+    size = -1  # Довжина рядків, з'єднаних переносами
+    for line in text.split("\n"):
+        if lines and size + 1 + len(line) > limit:
+            chunks.append("\n".join(lines))
+            lines = []
+            size = -1
+        # Рядок, задовгий для одного повідомлення, розрізається
+        while len(line) > limit:
+            chunks.append(line[:limit])
+            line = line[limit:]
+        lines.append(line)
+        size += 1 + len(line)
+    chunks.append("\n".join(lines))
+    # Telegram не надсилає порожні повідомлення, порожні рядки на місці розриву відкидаються
+    return [chunk for chunk in chunks if chunk.strip()] or chunks[-1:]
+
+async def answer_long(message, text, reply_markup=None, **kwargs):
+    """Надсилає відповідь будь-якої довжини, клавіатура додається до останньої частини
+
+    Частини надсилаються з обмеженням чату в OutboundLimiter.
+    """
+    chunks = split_message(text)
+    for chunk in chunks[:-1]:
+        await message.answer(chunk, **kwargs)
+    return await message.answer(chunks[-1], reply_markup=reply_markup, **kwargs)
+
 # Обробники команд
 @dp.message(Command("start", "cancel"))
 async def cmd_start(message: types.Message, state: FSMContext):
@@ -243,6 +1813,35 @@ async def cmd_start(message: types.Message, state: FSMContext):
     )
     await manage_messages(message.chat.id, msg.message_id, bot)
 
+@dp.message(Command("profile"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_profile(message: types.Message, command: CommandObject):
+    global profiling
+    try:
+        seconds = int(command.args) if command.args else PROFILE_SECONDS
+    except ValueError:
+        await message.answer("Використання: /profile [секунди]")
+        return
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+    if profiling:
+        await message.answer("⏱ Профілювання вже триває")
+        return
+    
+    profiling = True
+    await message.answer(f"⏱ Профілювання протягом {seconds} с...")
+    try:
+        samples, own, total = await asyncio.to_thread(sample_stacks, seconds)
+    finally:
+        profiling = False
+    if not samples:
+        await message.answer("⏱ Бот увесь час простоював")
+        return
+    
+    response = [f"<b>⏱ Профіль: {seconds} с, {samples} знімків</b>", "", "<b>Виконувалась сама:</b>"]
+    response += [f"<code>{count * 100 / samples:5.1f}%</code> {html.escape(name)}" for name, count in own.most_common(PROFILE_TOP)]
+    response += ["", "<b>Будь-де в стеку:</b>"]
+    response += [f"<code>{count * 100 / samples:5.1f}%</code> {html.escape(name)}" for name, count in total.most_common(PROFILE_TOP)]
+    await answer_long(message, "\n".join(response), parse_mode="HTML")
+
 # Обробники для задач
 @dp.message(F.text == "📋 Мої задачі")
 async def add_task_start(message: types.Message, state: FSMContext):
@@ -268,7 +1867,7 @@ async def process_task_text(message: types.Message, state: FSMContext):
     )
 
 @dp.message(TaskStates.waiting_for_deadline)
-async def process_task_deadline(message: types.Message, state: FSMContext):
+async def process_task_deadline(message: types.Message, state: FSMContext, user_data: UserData):
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
@@ -278,11 +1877,12 @@ async def process_task_deadline(message: types.Message, state: FSMContext):
     await state.set_state(TaskStates.waiting_for_category)
     await message.answer(
         "🏷 Оберіть категорію для задачі:",
-        reply_markup=get_categories_kb()
+        reply_markup=get_categories_kb(user_data)
     )
 
 @dp.message(TaskStates.waiting_for_category)
-async def process_task_category(message: types.Message, state: FSMContext):
+async def process_task_category(message: types.Message, state: FSMContext, user_data: UserData):
+    categories = user_data.categories
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаєmosь до головного меню", reply_markup=get_main_menu_kb())
@@ -294,6 +1894,7 @@ async def process_task_category(message: types.Message, state: FSMContext):
     
     task_data = await state.get_data()
     task = {
+        "id": user_data.new_task_id(),
         "text": task_data.get("task_text", ""),
         "deadline": task_data.get("deadline", ""),
         "category": message.text,
@@ -301,12 +1902,10 @@ async def process_task_category(message: types.Message, state: FSMContext):
         "completed": False,
         "completed_at": None
     }
-    tasks.append(task)
-    
-    # Оновлення статистики
-    stats_key = f"tasks_{datetime.now().strftime('%Y-%m')}"
-    statistics[stats_key] = statistics.get(stats_key, 0) + 1
-    save_data({"tasks": tasks, "notes": notes, "categories": categories, "statistics": statistics})
+    # Розбирається тут один раз, далі код лише порівнює збережений час
+    task["due"] = normalize_deadline(task["deadline"], task["created"])
+    commit_change(user_data, {"op": "add_task", "task": task})
+    await schedule_deadline_reminder(message.chat.id, task)
     
     await state.clear()
     await message.answer(
@@ -316,12 +1915,13 @@ async def process_task_category(message: types.Message, state: FSMContext):
 
 # Відмітка задач як виконаних/невиконаних
 @dp.message(F.text == "✅ Відмітити задачу")
-async def complete_task_start(message: types.Message, state: FSMContext):
+async def complete_task_start(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if not tasks:
         await message.answer("❌ Немає задач для відмітки.", reply_markup=get_main_menu_kb())
         return
     
-    active_tasks = [t for t in tasks if not t.get("completed", False)]
+    active_tasks = [t for t in tasks.values() if not t.get("completed", False)]
     if not active_tasks:
         await message.answer("❌ Всі задачі вже виконані.", reply_markup=get_main_menu_kb())
         return
@@ -329,25 +1929,25 @@ async def complete_task_start(message: types.Message, state: FSMContext):
     await state.set_state(TaskStates.waiting_for_task_complete)
     await message.answer(
         "Оберіть задачу для відмітки як виконану:",
-        reply_markup=get_tasks_kb(completed=False)
+        reply_markup=get_tasks_kb(user_data, completed=False)
     )
 
 @dp.message(TaskStates.waiting_for_task_complete)
-async def process_task_complete(message: types.Message, state: FSMContext):
+async def process_task_complete(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
         return
     
     if message.text.split(". ")[0].isdigit():
-        task_num = int(message.text.split(". ")[0]) - 1
-        if 0 <= task_num < len(tasks) and not tasks[task_num].get("completed", False):
-            tasks[task_num]["completed"] = True
-            tasks[task_num]["completed_at"] = str(datetime.now())
-            save_data({"tasks": tasks, "notes": notes, "categories": categories, "statistics": statistics})
+        task_id = int(message.text.split(". ")[0])
+        if task_id in tasks and not tasks[task_id].get("completed", False):
+            commit_change(user_data, {"op": "complete_task", "task_id": task_id, "at": str(datetime.now())})
+            await cancel_reminder(message.chat.id, task_id)
             await state.clear()
             await message.answer(
-                f"✅ Задачу '{tasks[task_num]['text']}' позначено як виконану.",
+                f"✅ Задачу '{tasks[task_id]['text']}' позначено як виконану.",
                 reply_markup=get_main_menu_kb()
             )
             return
@@ -355,12 +1955,13 @@ async def process_task_complete(message: types.Message, state: FSMContext):
     await message.answer("❌ Оберіть задачу зі списку або натисніть «Назад»")
 
 @dp.message(F.text == "🔄 Активувати задачу")
-async def uncomplete_task_start(message: types.Message, state: FSMContext):
+async def uncomplete_task_start(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if not tasks:
         await message.answer("❌ Немає задач для активації.", reply_markup=get_main_menu_kb())
         return
     
-    completed_tasks = [t for t in tasks if t.get("completed", False)]
+    completed_tasks = [t for t in tasks.values() if t.get("completed", False)]
     if not completed_tasks:
         await message.answer("❌ Немає виконаних задач.", reply_markup=get_main_menu_kb())
         return
@@ -368,25 +1969,25 @@ async def uncomplete_task_start(message: types.Message, state: FSMContext):
     await state.set_state(TaskStates.waiting_for_task_uncomplete)
     await message.answer(
         "Оберіть задачу для активації:",
-        reply_markup=get_tasks_kb(completed=True)
+        reply_markup=get_tasks_kb(user_data, completed=True)
     )
 
 @dp.message(TaskStates.waiting_for_task_uncomplete)
-async def process_task_uncomplete(message: types.Message, state: FSMContext):
+async def process_task_uncomplete(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
         return
     
     if message.text.split(". ")[0].isdigit():
-        task_num = int(message.text.split(". ")[0]) - 1
-        if 0 <= task_num < len(tasks) and tasks[task_num].get("completed", False):
-            tasks[task_num]["completed"] = False
-            tasks[task_num]["completed_at"] = None
-            save_data({"tasks": tasks, "notes": notes, "categories": categories, "statistics": statistics})
+        task_id = int(message.text.split(". ")[0])
+        if task_id in tasks and tasks[task_id].get("completed", False):
+            commit_change(user_data, {"op": "reactivate_task", "task_id": task_id})
+            await schedule_deadline_reminder(message.chat.id, tasks[task_id])
             await state.clear()
             await message.answer(
-                f"🔄 Задачу '{tasks[task_num]['text']}' активовано знову.",
+                f"🔄 Задачу '{tasks[task_id]['text']}' активовано знову.",
                 reply_markup=get_main_menu_kb()
             )
             return
@@ -395,24 +1996,27 @@ async def process_task_uncomplete(message: types.Message, state: FSMContext):
 
 # Статистика
 @dp.message(F.text == "📊 Статистика")
-async def show_statistics(message: types.Message):
-    # Статистика по задачам
-    completed_tasks = sum(1 for task in tasks if task.get("completed", False))
+async def show_statistics(message: types.Message, user_data: UserData):
+    tasks = user_data.tasks
+    notes = user_data.notes
+    statistics = user_data.statistics
+    # Статистика по задачам, рахується при зміні даних
+    completed_tasks = sum(user_data.completed_by_category.values())
     active_tasks = len(tasks) - completed_tasks
     
     # Перевірка протермінованих задач
-    overdue_tasks = 0
-    for task in tasks:
-        if not task.get("completed", False) and task.get("deadline"):
-            deadline = parse_deadline(task["deadline"])
-            if deadline and deadline < datetime.now():
-                overdue_tasks += 1
+    now = datetime.now().astimezone()
+    end_of_today = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    end_of_week = end_of_today + timedelta(days=6 - now.weekday())
+    overdue_tasks = user_data.count_due(end=format_due(now))
+    due_today = user_data.count_due(format_due(now), format_due(end_of_today))
+    due_this_week = user_data.count_due(format_due(now), format_due(end_of_week))
     
     # Статистика по категоріям
     category_stats = {}
-    for category in categories:
-        category_tasks = sum(1 for task in tasks if task.get("category", "") == category)
-        category_notes = sum(1 for note in notes if note.get("category", "") == category)
+    for category in user_data.categories:
+        category_tasks = user_data.active_by_category[category] + user_data.completed_by_category[category]
+        category_notes = user_data.notes_by_category[category]
         if category_tasks or category_notes:
             category_stats[category] = (category_tasks, category_notes)
     
@@ -421,6 +2025,8 @@ async def show_statistics(message: types.Message):
         f"✅ Виконано задач: {completed_tasks}",
         f"🔄 Активних задач: {active_tasks}",
         f"⏰ Протерміновано: {overdue_tasks}",
+        f"📅 На сьогодні: {due_today}",
+        f"🗓 На цьому тижні: {due_this_week}",
         f"📝 Всього нотаток: {len(notes)}",
         "\n📌 По категоріях:"
     ]
@@ -429,52 +2035,44 @@ async def show_statistics(message: types.Message):
         response.append(f"  {category}: задач - {task_count}, нотаток - {note_count}")
     
     # Графік продуктивності (текстовий)
-    months = sorted(statistics.keys())
+    months = sorted({key[len("tasks_"):] for key in statistics} | set(user_data.completed_by_month))
     if months:
         response.append("\n📈 Продуктивність по місяцях:")
         for month in months[-6:]:  # Останні 6 місяців
-            response.append(f"  {month}: {statistics[month]} задач")
+            response.append(f"  {month}: {statistics.get(f'tasks_{month}', 0)} задач, {user_data.completed_by_month[month]} виконано")
     
-    await message.answer("\n".join(response), reply_markup=get_main_menu_kb())
+    await answer_long(message, "\n".join(response), reply_markup=get_main_menu_kb())
 
 # Перегляд задач
 @dp.message(F.text == "📄 Переглянути задачі")
-async def show_tasks(message: types.Message):
+async def show_tasks(message: types.Message, user_data: UserData):
+    tasks = user_data.tasks
     if not tasks:
         await message.answer("❌ У вас ще немає задач.", reply_markup=get_main_menu_kb())
         return
     
-    tasks_list = []
-    for i, task in enumerate(tasks):
-        status = "✅" if task.get("completed", False) else "❌"
-        deadline = f" — {task['deadline']}" if task.get("deadline") else ""
-        completed_at = f" (завершено {task['completed_at']})" if task.get("completed_at") else ""
-        tasks_list.append(f"{i+1}. {status} {task['text']}{deadline} ({task['category']}){completed_at}")
-    
-    await message.answer(
-        f"📋 Ваші задачі:\n" + "\n".join(tasks_list),
-        reply_markup=get_back_kb()  # Тепер тільки кнопка "Назад"
-    )
+    text, page_kb = render_page(user_data, "t", 0)
+    await message.answer(text, reply_markup=page_kb or get_back_kb())
 
 @dp.callback_query(F.data == "complete_task")
-async def complete_task(callback: types.CallbackQuery):
+async def complete_task(callback: types.CallbackQuery, user_data: UserData):
+    tasks = user_data.tasks
     if not tasks:
         await callback.answer("Немає задач для завершення")
         return
     
     # Знаходимо першу невиконану задачу
-    for i, task in enumerate(tasks):
+    for task in tasks.values():
         if not task.get("completed", False):
-            task["completed"] = True
-            task["completed_at"] = str(datetime.now())
-            save_data({"tasks": tasks, "notes": notes, "categories": categories, "statistics": statistics})
+            commit_change(user_data, {"op": "complete_task", "task_id": task["id"], "at": str(datetime.now())})
+            await cancel_reminder(callback.message.chat.id, task["id"])
             await callback.message.edit_text(
                 f"📋 Ваші задачі:\n" + "\n".join(
-                    f"{j+1}. {'✅' if t.get('completed', False) else '❌'} {t['text']} — {t['deadline']} ({t['category']})"
+                    f"{t['id']}. {'✅' if t.get('completed', False) else '❌'} {t['text']} — {t['deadline']} ({t['category']})"
                     + (f" (завершено {t['completed_at']})" if t.get("completed_at") else "")
-                    for j, t in enumerate(tasks)
+                    for t in tasks.values()
                 ),
-                reply_markup=get_tasks_kb()
+                reply_markup=get_tasks_kb(user_data)
             )
             await callback.answer(f"Задачу '{task['text']}' позначено як виконану")
             return
@@ -489,8 +2087,54 @@ async def search_start(message: types.Message, state: FSMContext):
         reply_markup=get_back_kb()
     )
 
+@dp.message(StateFilter(SearchStates), F.text == "🔍 Продовжити пошук")
+async def search_continue(message: types.Message, state: FSMContext):
+    await search_start(message, state)
+
+@dp.message(StateFilter(SearchStates), F.text == "🔎 Нечіткий пошук")
+async def fuzzy_search_start(message: types.Message, state: FSMContext):
+    await state.set_state(SearchStates.waiting_for_fuzzy_query)
+    await message.answer(
+        "🔎 Введіть пошуковий запит, дрібні описки не завадять:",
+        reply_markup=get_back_kb()
+    )
+
+@dp.message(SearchStates.waiting_for_fuzzy_query)
+async def process_fuzzy_search(message: types.Message, state: FSMContext, user_data: UserData):
+    if message.text == "◀️ Назад":
+        await state.clear()
+        await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
+        return
+    
+    found, words = user_data.search_index.fuzzy_search(message.text)
+    
+    # Спершу найкращі збіги, задачі й нотатки разом
+    results = []
+    for kind, item in found:
+        snippet = highlight(item["text"], words)
+        category = html.escape(item["category"])
+        if kind == "task":
+            status = "✅" if item.get("completed", False) else "❌"
+            results.append(f"📋 {item['id']}. {status} {snippet} ({category})")
+        else:
+            results.append(f"🧾 {item['id']}. {snippet} ({category})")
+    
+    await message.answer(
+        "🔎 Найкращі збіги:\n" + "\n".join(results) if results else "🔍 Нічого не знайдено за вашим запитом.",
+        parse_mode="HTML",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[
+                [KeyboardButton(text="🔍 Продовжити пошук"), KeyboardButton(text="🔎 Нечіткий пошук")],
+                [KeyboardButton(text="◀️ Назад")]
+            ],
+            resize_keyboard=True
+        )
+    )
+
 @dp.message(SearchStates.waiting_for_search_query)
-async def process_search(message: types.Message, state: FSMContext):
+async def process_search(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
+    categories = user_data.categories
     if message.text == "◀️ Назад":  # Виправлено умову
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
@@ -498,27 +2142,25 @@ async def process_search(message: types.Message, state: FSMContext):
     
     search_query = message.text.lower()
     results = []
+    found = user_data.search_index.search(search_query)
     
     # Пошук у задачах
     task_results = []
-    for i, task in enumerate(tasks):
-        if (search_query in task['text'].lower() or 
-            search_query in task['category'].lower() or 
-            search_query in task.get('deadline', '').lower()):
+    for kind, task in found:
+        if kind == "task":
             status = "✅" if task.get("completed", False) else "❌"
             deadline = f" — {task['deadline']}" if task.get("deadline") else ""
-            task_results.append(f"{i+1}. {status} {task['text']}{deadline} ({task['category']})")
+            task_results.append(f"{task['id']}. {status} {task['text']}{deadline} ({task['category']})")
     
     if task_results:
         results.append("📋 Знайдені задачі:\n" + "\n".join(task_results))
     
     # Пошук у нотатках
     note_results = []
-    for i, note in enumerate(notes):
-        if (search_query in note['text'].lower() or 
-            search_query in note['category'].lower()):
-            task_text = tasks[note.get("task_id", 0)].get("text", "Невідома задача")  # Виправлено синтаксис
-            note_results.append(f"{i+1}. {note['text']} (до задачі: '{task_text}', {note['category']})")
+    for kind, note in found:
+        if kind == "note":
+            task_text = tasks.get(note["task_id"], {}).get("text", "Невідома задача")  # Виправлено синтаксис
+            note_results.append(f"{note['id']}. {note['text']} (до задачі: '{task_text}', {note['category']})")
     
     if note_results:
         results.append("\n🧾 Знайдені нотатки:\n" + "\n".join(note_results))
@@ -529,19 +2171,19 @@ async def process_search(message: types.Message, state: FSMContext):
         results.append("\n🏷 Знайдені категорії:\n" + ", ".join(category_results))
     
     if results:
-        await message.answer("\n".join(results), 
-                           reply_markup=ReplyKeyboardMarkup(
-                               keyboard=[
-                                   [KeyboardButton(text="🔍 Продовжити пошук")],
-                                   [KeyboardButton(text="◀️ Назад")]
-                               ],
-                               resize_keyboard=True
-                           ))
+        await answer_long(message, "\n".join(results),
+                          reply_markup=ReplyKeyboardMarkup(
+                              keyboard=[
+                                  [KeyboardButton(text="🔍 Продовжити пошук"), KeyboardButton(text="🔎 Нечіткий пошук")],
+                                  [KeyboardButton(text="◀️ Назад")]
+                              ],
+                              resize_keyboard=True
+                          ))
     else:
         await message.answer("🔍 Нічого не знайдено за вашим запитом.",
                            reply_markup=ReplyKeyboardMarkup(
                                keyboard=[
-                                   [KeyboardButton(text="🔍 Продовжити пошук")],
+                                   [KeyboardButton(text="🔍 Продовжити пошук"), KeyboardButton(text="🔎 Нечіткий пошук")],
                                    [KeyboardButton(text="◀️ Назад")]
                                ],
                                resize_keyboard=True
@@ -552,7 +2194,8 @@ async def process_search(message: types.Message, state: FSMContext):
 
 # Обробник для нотаток
 @dp.message(F.text == "🧠 Нотатки")
-async def add_note_start(message: types.Message, state: FSMContext):
+async def add_note_start(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if not tasks:
         await message.answer("❌ Спочатку додайте хоча б одну задачу, до якої можна прив'язати нотатку.", reply_markup=get_main_menu_kb())
         return
@@ -560,20 +2203,21 @@ async def add_note_start(message: types.Message, state: FSMContext):
     await state.set_state(NoteStates.waiting_for_task_selection)
     await message.answer(
         "📌 Оберіть задачу, до якої відноситься нотатка:",
-        reply_markup=get_tasks_for_notes_kb()
+        reply_markup=get_tasks_for_notes_kb(user_data)
     )
 
 @dp.message(NoteStates.waiting_for_task_selection)
-async def process_note_task_selection(message: types.Message, state: FSMContext):
+async def process_note_task_selection(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
         return
     
     if message.text.split(". ")[0].isdigit():
-        task_num = int(message.text.split(". ")[0]) - 1
-        if 0 <= task_num < len(tasks):
-            await state.update_data(task_id=task_num)
+        task_id = int(message.text.split(". ")[0])
+        if task_id in tasks:
+            await state.update_data(task_id=task_id)
             await state.set_state(NoteStates.waiting_for_text)
             await message.answer(
                 "📝 Введіть текст нотатки:",
@@ -584,7 +2228,7 @@ async def process_note_task_selection(message: types.Message, state: FSMContext)
     await message.answer("❌ Оберіть задачу зі списку або натисніть «Назад»")
 
 @dp.message(NoteStates.waiting_for_text)
-async def process_note_text(message: types.Message, state: FSMContext):
+async def process_note_text(message: types.Message, state: FSMContext, user_data: UserData):
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
@@ -594,11 +2238,12 @@ async def process_note_text(message: types.Message, state: FSMContext):
     await state.set_state(NoteStates.waiting_for_category)
     await message.answer(
         "🏷 Оберіть категорію для нотатки:",
-        reply_markup=get_categories_kb()
+        reply_markup=get_categories_kb(user_data)
     )
 
 @dp.message(NoteStates.waiting_for_category)
-async def process_note_category(message: types.Message, state: FSMContext):
+async def process_note_category(message: types.Message, state: FSMContext, user_data: UserData):
+    categories = user_data.categories
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
@@ -610,13 +2255,13 @@ async def process_note_category(message: types.Message, state: FSMContext):
     
     note_data = await state.get_data()
     note = {
+        "id": user_data.new_note_id(),
         "text": note_data.get("note_text", ""),
-        "task_id": note_data.get("task_id", 0),
+        "task_id": note_data.get("task_id"),
         "category": message.text,
         "created": str(datetime.now())
     }
-    notes.append(note)
-    save_data({"tasks": tasks, "notes": notes, "categories": categories, "statistics": statistics})
+    commit_change(user_data, {"op": "add_note", "note": note})
     
     await state.clear()
     await message.answer(
@@ -626,56 +2271,109 @@ async def process_note_category(message: types.Message, state: FSMContext):
 
 # Перегляд нотаток
 @dp.message(F.text == "🧾 Переглянути нотатки")
-async def show_notes(message: types.Message):
+async def show_notes(message: types.Message, user_data: UserData):
+    notes = user_data.notes
     if not notes:
         await message.answer("❌ Нотаток поки немає.", reply_markup=get_main_menu_kb())
         return
     
-    notes_list = []
-    for i, note in enumerate(notes):
-        task_text = tasks[note.get("task_id", 0)].get("text", "Невідома задача")
-        notes_list.append(f"{i+1}. {note['text']} (до задачі: '{task_text}', {note['category']})")
+    text, page_kb = render_page(user_data, "n", 0)
+    await message.answer(text, reply_markup=page_kb or get_back_kb())
+
+# Списки по сторінках: заголовок виду, елементи, що він показує, як показати один елемент і текст після списку
+def task_line(user_data, task):
+    status = "✅" if task.get("completed", False) else "❌"
+    deadline = f" — {task['deadline']}" if task.get("deadline") else ""
+    completed_at = f" (завершено {task['completed_at']})" if task.get("completed_at") else ""
+    return f"{task['id']}. {status} {task['text']}{deadline} ({task['category']}){completed_at}"
+
+def note_line(user_data, note):
+    task_text = user_data.tasks.get(note["task_id"], {}).get("text", "Невідома задача")
+    return f"{note['id']}. {note['text']} (до задачі: '{task_text}', {note['category']})"
+
+PAGED_VIEWS = {
+    "t": ("📋 Ваші задачі:", lambda user_data: user_data.tasks, task_line, ""),
+    "n": ("🧾 Ваші нотатки:", lambda user_data: user_data.notes, note_line, ""),
+    "dt": (
+        "Оберіть номер задачі для видалення:",
+        lambda user_data: user_data.tasks,
+        lambda user_data, task: f"{task['id']}. {task['text']} — {task['deadline']}",
+        "Напишіть номер задачі або натисніть '◀️ Назад'"
+    ),
+    "dn": (
+        "Оберіть номер нотатки для видалення:",
+        lambda user_data: user_data.notes,
+        lambda user_data, note: f"{note['id']}. {note['text']}",
+        "Напишіть номер нотатки або натисніть '◀️ Назад'"
+    ),
+}
+
+def shorten(text, limit=PAGE_LINE_LIMIT):
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def render_page(user_data, view, page):
+    """Текст однієї сторінки списку і її клавіатура навігації, None якщо все вміщається на одній сторінці"""
+    title, get_items, line, footer = PAGED_VIEWS[view]
+    items = get_items(user_data)
+    pages = max(1, math.ceil(len(items) / PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    lines = [shorten(line(user_data, item)) for item in islice(items.values(), page * PAGE_SIZE, (page + 1) * PAGE_SIZE)]
+    text = title + "\n" + "\n".join(lines)
+    if pages > 1:
+        text += f"\n\nСторінка {page + 1}/{pages}"
+    if footer and pages == 1:
+        # Для списку по сторінках цей текст надсилається окремим повідомленням з кнопкою "Назад"
+        text += "\n\n" + footer
+    return text, get_page_kb(view, page, pages) if pages > 1 else None
+
+@dp.callback_query(F.data.startswith("page:"))
+async def turn_page(callback: types.CallbackQuery, user_data: UserData):
+    try:
+        _, view, page = callback.data.split(":")
+        text, page_kb = render_page(user_data, view, int(page))
+    except (ValueError, KeyError):
+        # Дані кнопки надходять від клієнта, некоректні ігноруються
+        await callback.answer()
+        return
     
-    await message.answer(
-        f"🧾 Ваші нотатки:\n" + "\n".join(notes_list),
-        reply_markup=get_back_kb()
-    )
+    try:
+        await callback.message.edit_text(text, reply_markup=page_kb)
+    except TelegramBadRequest as e:
+        # Натискання кнопки сторінки, яка вже показана, нічого не змінює
+        if "message is not modified" not in str(e):
+            raise
+    await callback.answer()
 
 # Видалення задач
 @dp.message(F.text == "🗑️ Видалити задачу")
-async def delete_task_start(message: types.Message, state: FSMContext):
+async def delete_task_start(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if not tasks:
         await message.answer("❌ Немає задач для видалення.", reply_markup=get_main_menu_kb())
         return
     
-    tasks_list = "\n".join(f"{i+1}. {task['text']} — {task['deadline']}" for i, task in enumerate(tasks))
     await state.set_state(TaskStates.waiting_for_task_delete)
-    await message.answer(
-        f"Оберіть номер задачі для видалення:\n{tasks_list}\n\n"
-        "Напишіть номер задачі або натисніть '◀️ Назад'",
-        reply_markup=get_back_kb()
-    )
+    text, page_kb = render_page(user_data, "dt", 0)
+    await message.answer(text, reply_markup=page_kb or get_back_kb())
+    if page_kb:
+        # Сторінка має кнопки навігації, тож кнопка "Назад" надсилається з коротким повідомленням
+        await message.answer("Напишіть номер задачі або натисніть '◀️ Назад'", reply_markup=get_back_kb())
 
 @dp.message(TaskStates.waiting_for_task_delete)
-async def process_task_delete(message: types.Message, state: FSMContext):
+async def process_task_delete(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
         return
     
     if message.text.isdigit():
-        task_num = int(message.text) - 1
-        if 0 <= task_num < len(tasks):
-            deleted_task = tasks.pop(task_num)
-            # Видаляємо нотатки, пов'язані з цією задачею
-            global notes
-            notes = [note for note in notes if note.get("task_id", -1) != task_num]
+        task_id = int(message.text)
+        if task_id in tasks:
+            deleted_task = tasks[task_id]
+            commit_change(user_data, {"op": "delete_task", "task_id": task_id})
             # Видаляємо нагадування для цієї задачі
-            try:
-                scheduler.remove_job(f"reminder_{message.chat.id}_{task_num}")
-            except Exception:
-                pass
-            save_data({"tasks": tasks, "notes": notes, "categories": categories, "statistics": statistics})
+            await cancel_reminder(message.chat.id, task_id)
             await message.answer(
                 f"✅ Задачу видалено: {deleted_task['text']} — {deleted_task['deadline']}",
                 reply_markup=get_main_menu_kb()  # Додано повернення в меню
@@ -688,31 +2386,32 @@ async def process_task_delete(message: types.Message, state: FSMContext):
 
 # Видалення нотаток
 @dp.message(F.text == "🗑️ Видалити нотатку")
-async def delete_note_start(message: types.Message, state: FSMContext):
+async def delete_note_start(message: types.Message, state: FSMContext, user_data: UserData):
+    notes = user_data.notes
     if not notes:
         await message.answer("❌ Немає нотаток для видалення.", reply_markup=get_main_menu_kb())
         return
     
-    notes_list = "\n".join(f"{i+1}. {note['text']}" for i, note in enumerate(notes))
     await state.set_state(NoteStates.waiting_for_note_delete)
-    await message.answer(
-        f"Оберіть номер нотатки для видалення:\n{notes_list}\n\n"
-        "Напишіть номер нотатки або натисніть '◀️ Назад'",
-        reply_markup=get_back_kb()
-    )
+    text, page_kb = render_page(user_data, "dn", 0)
+    await message.answer(text, reply_markup=page_kb or get_back_kb())
+    if page_kb:
+        # Сторінка має кнопки навігації, тож кнопка "Назад" надсилається з коротким повідомленням
+        await message.answer("Напишіть номер нотатки або натисніть '◀️ Назад'", reply_markup=get_back_kb())
 
 @dp.message(NoteStates.waiting_for_note_delete)
-async def process_note_delete(message: types.Message, state: FSMContext):
+async def process_note_delete(message: types.Message, state: FSMContext, user_data: UserData):
+    notes = user_data.notes
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
         return
     
     if message.text.isdigit():
-        note_num = int(message.text) - 1
-        if 0 <= note_num < len(notes):
-            deleted_note = notes.pop(note_num)
-            save_data({"tasks": tasks, "notes": notes, "categories": categories, "statistics": statistics})
+        note_id = int(message.text)
+        if note_id in notes:
+            deleted_note = notes[note_id]
+            commit_change(user_data, {"op": "delete_note", "note_id": note_id})
             await state.clear()
             await message.answer(
                 f"✅ Нотатку видалено: {deleted_note['text']}",
@@ -724,12 +2423,13 @@ async def process_note_delete(message: types.Message, state: FSMContext):
         await message.answer("❌ Будь ласка, введіть номер нотатки.")
 
 @dp.message(F.text == "⏰ Нагадування")
-async def set_reminder_start(message: types.Message, state: FSMContext):
+async def set_reminder_start(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if not tasks:
         await message.answer("❌ Немає задач для нагадування.", reply_markup=get_main_menu_kb())
         return
     
-    active_tasks = [t for t in tasks if not t.get("completed", False)]
+    active_tasks = [t for t in tasks.values() if not t.get("completed", False)]
     if not active_tasks:
         await message.answer("❌ Всі задачі вже виконані.", reply_markup=get_main_menu_kb())
         return
@@ -737,20 +2437,21 @@ async def set_reminder_start(message: types.Message, state: FSMContext):
     await state.set_state(ReminderStates.waiting_for_reminder_task)
     await message.answer(
         "📌 Оберіть задачу для нагадування:",
-        reply_markup=get_tasks_kb(completed=False)
+        reply_markup=get_tasks_kb(user_data, completed=False)
     )
 
 @dp.message(ReminderStates.waiting_for_reminder_task)
-async def process_reminder_task(message: types.Message, state: FSMContext):
+async def process_reminder_task(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
         return
     
     if message.text.split(". ")[0].isdigit():
-        task_num = int(message.text.split(". ")[0]) - 1
-        if 0 <= task_num < len(tasks) and not tasks[task_num].get("completed", False):
-            await state.update_data(task_num=task_num)
+        task_id = int(message.text.split(". ")[0])
+        if task_id in tasks and not tasks[task_id].get("completed", False):
+            await state.update_data(task_id=task_id)
             await state.set_state(ReminderStates.waiting_for_reminder_time)
             await message.answer(
                 "⏰ Введіть час нагадування (наприклад: '15.12 14:30' або 'через 2 години'):\n"
@@ -768,7 +2469,8 @@ async def process_reminder_task(message: types.Message, state: FSMContext):
     await message.answer("❌ Оберіть задачу зі списку або натисніть «Назад»", reply_markup=get_back_kb())
 
 @dp.message(ReminderStates.waiting_for_reminder_time)
-async def process_reminder_time(message: types.Message, state: FSMContext):
+async def process_reminder_time(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
@@ -780,8 +2482,8 @@ async def process_reminder_time(message: types.Message, state: FSMContext):
         return
     
     reminder_data = await state.get_data()
-    task_num = reminder_data.get("task_num")
-    task = tasks[task_num]
+    task_id = reminder_data.get("task_id")
+    task = tasks[task_id]
     
     try:
         now = datetime.now()
@@ -814,19 +2516,7 @@ async def process_reminder_time(message: types.Message, state: FSMContext):
                 except ValueError:
                     raise ValueError("Невірний формат часу")
         
-        # Видаляємо старі нагадування
-        try:
-            scheduler.remove_job(f"reminder_{message.chat.id}_{task_num}")
-        except Exception:
-            pass
-        
-        # Додаємо нове нагадування
-        scheduler.add_job(
-            send_reminder,
-            DateTrigger(run_date=reminder_time),
-            args=(message.chat.id, f"⏰ Нагадування: {task['text']}\nДедлайн: {task.get('deadline', 'не вказано')}"),
-            id=f"reminder_{message.chat.id}_{task_num}"
-        )
+        await schedule_reminder(message.chat.id, task_id, "custom", reminder_time, reminder_text(task))
         
         await message.answer(
             f"✅ Нагадування встановлено на {reminder_time.strftime('%d.%m %H:%M')}",
@@ -864,37 +2554,9 @@ async def handle_back(message: types.Message, state: FSMContext):
         reply_markup=get_main_menu_kb()
     )
 
-# Покращена функція парсингу дедлайнів
-def parse_deadline(deadline_str):
-    if not deadline_str:
-        return None
-    
-    try:
-        # Використовуємо dateparser для гнучкого парсингу
-        parsed_date = dateparser.parse(
-            deadline_str,
-            languages=['uk', 'ru', 'en'],
-            settings={'PREFER_DATES_FROM': 'future'}
-        )
-        
-        if parsed_date:
-            # Якщо дата в минулому (наприклад, для "15.12"), додаємо рік
-            if parsed_date < datetime.now():
-                if len(deadline_str) <= 5:  # Формати типу "15.12" або "14:30"
-                    if ':' in deadline_str:  # Час без дати
-                        parsed_date = parsed_date.replace(year=datetime.now().year + 1)
-                    else:  # Дата без року
-                        parsed_date = parsed_date.replace(year=datetime.now().year + 1)
-            
-            return parsed_date
-        
-        return None
-    except Exception as e:
-        logger.error(f"Помилка парсингу дедлайну '{deadline_str}': {e}")
-        return None
-
 # Покращена функція для нагадувань
-async def process_reminder_time(message: types.Message, state: FSMContext):
+async def process_reminder_time(message: types.Message, state: FSMContext, user_data: UserData):
+    tasks = user_data.tasks
     if message.text == "◀️ Назад":
         await state.clear()
         await message.answer("Повертаємось до головного меню", reply_markup=get_main_menu_kb())
@@ -906,14 +2568,14 @@ async def process_reminder_time(message: types.Message, state: FSMContext):
         return
     
     reminder_data = await state.get_data()
-    task_num = reminder_data.get("task_num")
+    task_id = reminder_data.get("task_id")
     
-    if not (0 <= task_num < len(tasks)):
+    if task_id not in tasks:
         await message.answer("❌ Помилка: задача не знайдена")
         await state.clear()
         return
     
-    task = tasks[task_num]
+    task = tasks[task_id]
     
     try:
         reminder_time = parse_deadline(message.text)
@@ -924,19 +2586,7 @@ async def process_reminder_time(message: types.Message, state: FSMContext):
             await message.answer("❌ Час нагадування вже минув. Введіть майбутню дату/час.")
             return
         
-        # Видаляємо старі нагадування
-        try:
-            scheduler.remove_job(f"reminder_{message.chat.id}_{task_num}")
-        except Exception as e:
-            logger.warning(f"Не вдалося видалити старе нагадування: {e}")
-        
-        # Додаємо нове нагадування
-        scheduler.add_job(
-            send_reminder,
-            DateTrigger(run_date=reminder_time),
-            args=(message.chat.id, f"⏰ Нагадування: {task['text']}\nДедлайн: {task.get('deadline', 'не вказано')}"),
-            id=f"reminder_{message.chat.id}_{task_num}"
-        )
+        await schedule_reminder(message.chat.id, task_id, "custom", reminder_time, reminder_text(task))
         
         await message.answer(
             f"✅ Нагадування встановлено на {reminder_time.strftime('%d.%m.%Y %H:%M')}",
@@ -967,6 +2617,10 @@ async def manage_messages(chat_id: int, new_message_id: int, bot: Bot):
     """Функція для керування історією повідомлень (зберігає тільки 3 останні)"""
     if chat_id not in user_messages:
         user_messages[chat_id] = []
+        # Повідомлення найдавніше активного чату забуваються, їх просто не буде видалено пізніше
+        if len(user_messages) > MAX_LOADED_USERS:
+            user_messages.popitem(last=False)
+    user_messages.move_to_end(chat_id)
     
     user_messages[chat_id].append(new_message_id)
     
@@ -978,13 +2632,37 @@ async def manage_messages(chat_id: int, new_message_id: int, bot: Bot):
         except Exception as e:
             logger.error(f"Не вдалося видалити повідомлення: {e}")
 
-async def send_reminder(chat_id, text):
+def reminder_text(task):
+    return f"⏰ Нагадування: {task['text']}\nДедлайн: {task.get('deadline', 'не вказано')}"
+
+async def schedule_reminder(chat_id, task_id, kind, fire_at, text):
+    """Планує нагадування задачі замість попереднього того ж виду і зберігає його на випадок перезапуску"""
+    reminder_queue.add(chat_id, task_id, kind, fire_at, text)
+    await run_in_storage(reminders.set, chat_id, task_id, kind, format_due(fire_at), text)
+
+async def schedule_deadline_reminder(chat_id, task):
+    """Нагадує про активну задачу в її дедлайн, якщо він ще попереду"""
+    if task.get("due") and task["due"] > format_due(datetime.now()):
+        await schedule_reminder(chat_id, task["id"], "deadline", due_to_datetime(task["due"]), reminder_text(task))
+
+async def cancel_reminder(chat_id, task_id):
+    """Скасовує всі нагадування задачі"""
+    for kind in REMINDER_KINDS:
+        reminder_queue.cancel(chat_id, task_id, kind)
+    await run_in_storage(reminders.remove, chat_id, task_id)
+
+async def send_reminder(chat_id, task_id, kind, text, fire_at):
     try:
         msg = await bot.send_message(
             chat_id,
             f"<b>{text}</b>",
             parse_mode="HTML"
         )
+        # Вимірюється, коли Telegram його прийняв, разом з очікуванням в обмежувачі відправки
+        reminder_lag_seconds.observe(max(0.0, time.time() - fire_at))
+        # Видаляється лише після відправки, невдале надсилається знову після перезапуску; заново встановлене тим часом залишається
+        if (chat_id, task_id, kind) not in reminder_queue.entries:
+            await run_in_storage(reminders.remove, chat_id, task_id, kind)
         await manage_messages(chat_id, msg.message_id, bot)  # Тепер manage_messages визначена
     except Exception as e:
         logger.error(f"Помилка при відправці нагадування: {e}")
@@ -996,10 +2674,10 @@ async def export_to_csv(chat_id):
 
         with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
             fieldnames = ['text', 'deadline', 'category', 'created', 'completed', 'completed_at']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
 
             writer.writeheader()
-            for task in tasks:
+            for task in (await get_user_data(chat_id)).tasks.values():
                 writer.writerow(task)
 
         await bot.send_document(
@@ -1011,43 +2689,260 @@ async def export_to_csv(chat_id):
         logger.error(f"Помилка експорту в CSV: {e}")
         await bot.send_message(chat_id, "❌ Помилка при експорті в CSV")
 
+async def fill_reminder_store():
+    """Заповнює нове сховище нагадувань з дедлайнів задач"""
+    for chat_id in await run_in_storage(storage.chat_ids):
+        # Читаються прямо зі сховища, щоб старт не заповнював кеш усіма чатами
+        try:
+            user_data = await run_in_storage(load_data, chat_id)
+        except ValueError as e:
+            logger.error(f"Нагадування чату {chat_id} не відновлено: {e}")
+            continue
+        for task in user_data.tasks_due(start=format_due(datetime.now())):
+            await run_in_storage(reminders.set, chat_id, task["id"], "deadline", task["due"], reminder_text(task))
+
 async def on_startup():
     try:
-        scheduler.start()
+        reminder_queue.start()
         logger.info("Бот запущений")
+        if reminders.created:
+            # Перший старт зі сховищем нагадувань: заповнюємо його з дедлайнів задач
+            await fill_reminder_store()
         # Відновлення нагадувань при старті
-        for i, task in enumerate(tasks):
-            if not task.get("completed", False) and task.get("deadline"):
-                deadline = parse_deadline(task["deadline"])
-                if deadline and deadline > datetime.now():
-                    scheduler.add_job(
-                        send_reminder,
-                        DateTrigger(run_date=deadline),
-                        args=("global", f"⏰ Нагадування: {task['text']}\nДедлайн: {task.get('deadline', 'не вказано')}"),
-                        id=f"reminder_global_{i}"
-                    )
+        for chat_id, task_id, kind, fire_at, text in await run_in_storage(
+            reminders.pending, format_due(datetime.now() - timedelta(hours=REMINDER_GRACE_HOURS))
+        ):
+            if handles_chat(chat_id):
+                # Прострочені опиняються на початку черги й надсилаються одразу
+                reminder_queue.add(chat_id, task_id, kind, due_to_datetime(fire_at), text)
+        if METRICS_PORT:
+            await start_metrics_server()
     except Exception as e:
         logger.error(f"Помилка при запуску: {e}")
 
 async def on_shutdown():
     try:
-        scheduler.shutdown()
+        # Записуємо зміни, що ще чекають SAVE_DELAY
+        await flush_changes()
+        await fsm_storage.close()
+        storage_executor.shutdown()
+        reminder_queue.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
         logger.info("Бот зупинений")
     except Exception as e:
         logger.error(f"Помилка при зупинці: {e}")
 
+# Режим вебхука
+webhook_slots = asyncio.Semaphore(WEBHOOK_MAX_UPDATES)
+
+async def handle_webhook(request):
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if WEBHOOK_SECRET and not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return web.Response(status=401)
+    try:
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    except ValueError:
+        return web.Response(status=400)
+    
+    if update_queues:
+        route_update(update)
+        return web.Response()
+    async with webhook_slots:
+        await process_update(update)
+    return web.Response()
+
+async def process_update(update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        # Записується в лог і відкидається, інакше Telegram надсилатиме те саме оновлення знову
+        logger.error(f"Помилка обробки оновлення {update.update_id}: {e}")
+
+def create_webhook_app():
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    if not update_queues:
+        # Запускає on_startup та on_shutdown разом з веб-застосунком, робочі процеси запускають власні
+        setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook():
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET не задано, будь-хто, хто знає адресу, може надсилати оновлення")
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                max_connections=WEBHOOK_MAX_UPDATES,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+        logger.info(f"Очікуємо оновлення на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+# Ендпоінт метрик
+metrics_runner = None
+
+def render_metrics(totals=None):
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    outbound = outbound_limiter.metrics()
+    for name, kind, help_text, value in [
+        ("pm_loaded_chats", "gauge", "Чатів завантажено в пам'ять", len(users)),
+        ("pm_loaded_tasks", "gauge", "Задач лише в чатах, завантажених у пам'ять цього процесу, усі рахує pm_tasks при сховищі SQLite",
+         sum(len(user_data.tasks) for user_data in users.values())),
+        ("pm_loaded_notes", "gauge", "Нотаток лише в чатах, завантажених у пам'ять цього процесу, усі рахує pm_notes при сховищі SQLite",
+         sum(len(user_data.notes) for user_data in users.values())),
+        ("pm_scheduled_reminders", "gauge", "Нагадувань чекає на відправку", len(reminder_queue)),
+        ("pm_outbound_queue_depth", "gauge", "Запитів чекає на свою чергу надсилання", outbound["queue_depth"]),
+        ("pm_outbound_sent_total", "counter", "Запитів надіслано в чати", outbound["sent"]),
+        ("pm_outbound_retries_total", "counter", "Запитів повторено після retry_after", outbound["retries"]),
+        ("pm_outbound_failed_total", "counter", "Запитів залишено після MAX_SEND_RETRIES", outbound["failed"]),
+    ] + ([
+        ("pm_tasks", "gauge", "Задач у сховищі, в усіх чатах цього процесу", totals[0]),
+        ("pm_notes", "gauge", "Нотаток у сховищі, в усіх чатах цього процесу", totals[1]),
+    ] if totals is not None else []):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics(request):
+    # Рахуються сховищем, коли воно може зробити це дешево (SQLite), кожен процес-обробник рахує свою частку чатів
+    totals = await run_in_storage(storage.count_items, (WORKERS, worker_index) if worker_index is not None else None)
+    return web.Response(body=render_metrics(totals).encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def start_metrics_server():
+    global metrics_runner
+    # Кожен робочий процес має власні метрики, на власному порту
+    port = METRICS_PORT + (worker_index + 1 if worker_index is not None else 0)
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, port).start()
+    logger.info(f"Метрики на http://{METRICS_HOST}:{port}/metrics")
+
+# Робочі процеси
+update_queues = []  # У головному процесі - по черзі оновлень на кожен робочий процес
+worker_index = None  # У робочому процесі - яку частку чатів він обробляє
+
+def chat_key(update):
+    context = UserContextMiddleware.resolve_event_context(update)
+    if context.chat:
+        return context.chat.id
+    return context.user.id if context.user else 0
+
+def handles_chat(chat_id):
+    return worker_index is None or chat_id % WORKERS == worker_index
+
+def route_update(update):
+    """Передає оновлення робочому процесу, якому належить його чат, тож оновлення, стан і дані чату лишаються в одному процесі"""
+    update_queues[chat_key(update) % WORKERS].put(update.model_dump_json(exclude_unset=True, by_alias=True))
+
+async def poll_updates():
+    offset = None
+    allowed_updates = dp.resolve_used_update_types()
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Помилка отримання оновлень: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            route_update(update)
+            offset = update.update_id + 1
+
+async def run_sharded():
+    """Отримує оновлення в цьому процесі й обробляє їх у WORKERS робочих процесах"""
+    if reminders.created:
+        await fill_reminder_store()
+    context = multiprocessing.get_context("spawn")
+    update_queues.extend(context.Queue() for _ in range(WORKERS))
+    workers = [
+        context.Process(target=run_worker, args=(index, queue), name=f"worker-{index}")
+        for index, queue in enumerate(update_queues)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Запущено робочих процесів: {WORKERS}")
+    try:
+        if RUN_MODE == "webhook":
+            await run_webhook()
+        else:
+            await poll_updates()
+    finally:
+        for queue in update_queues:
+            queue.put(None)
+        for worker in workers:
+            await asyncio.get_running_loop().run_in_executor(None, worker.join)
+
+def run_worker(index, updates):
+    """Точка входу робочого процесу"""
+    global worker_index
+    worker_index = index
+    # Обмеження Telegram діє на весь бот, робочі процеси ділять його між собою
+    rate = GLOBAL_SEND_RATE / WORKERS
+    outbound_limiter.global_bucket = TokenBucket(rate, max(1, rate))
+    try:
+        asyncio.run(serve_worker(updates))
+    except KeyboardInterrupt:
+        pass
+
+async def serve_worker(updates):
+    await on_startup()
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(WORKER_MAX_UPDATES)
+    chat_tails = {}  # Останнє оновлення кожного чату, яке ще обробляється
+
+    async def handle(update, previous):
+        # Оновлення одного чату обробляються одне за одним, в порядку надходження
+        if previous is not None:
+            await asyncio.wait([previous])
+        await process_update(update)
+
+    def finished(key, handling):
+        slots.release()
+        if chat_tails.get(key) is handling:
+            del chat_tails[key]
+
+    try:
+        while True:
+            await slots.acquire()
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            update = types.Update.model_validate_json(data, context={"bot": bot})
+            key = chat_key(update)
+            handling = chat_tails[key] = loop.create_task(handle(update, chat_tails.get(key)))
+            handling.add_done_callback(lambda handling, key=key: finished(key, handling))
+        await asyncio.gather(*chat_tails.values())
+    finally:
+        await on_shutdown()
+        await bot.session.close()
+
 async def main():
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
     try:
-        await dp.start_polling(bot)
+        if WORKERS:
+            await run_sharded()
+        elif RUN_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
     except Exception as e:
         logger.error(f"Помилка при роботі бота: {e}")
     finally:
         await bot.session.close()
 
 if __name__ == "__main__":
-    import asyncio
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,13 @@
+"""Imports the English bot script as a module, for the benchmarks in this folder."""
+import importlib.util
+import os
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "PM Assistant English Version", "PM Assistant Bot English Version.py")
+
+def load_bot():
+    # The bot only needs a well-formed token to be imported; it creates its data folders in the current directory
+    os.environ.setdefault("BOT_TOKEN", "123456:" + "x" * 35)
+    spec = importlib.util.spec_from_file_location("pm_bot", BOT_SCRIPT)
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
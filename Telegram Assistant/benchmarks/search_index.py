@@ -0,0 +1,66 @@
+"""Search benchmark: the per-chat search index against a linear substring scan of every task and note.
+
+Usage: python search_index.py [item counts...]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from bot_loader import load_bot
+
+WORDS = [
+    "buy", "milk", "report", "meeting", "deadline", "review", "call", "project", "budget", "invoice",
+    "купити", "молоко", "звіт", "зустріч", "дедлайн", "перевірити", "дзвінок", "проєкт", "бюджет", "рахунок",
+]
+QUERIES = ["milk", "звіт", "port", "4242", "project budget", "xyz"]
+
+def linear_search(tasks, notes, query):
+    # The search as it was before the index: a substring check of every field of every item
+    query = query.lower()
+    found = [task for task in tasks if query in task["text"].lower() or query in task["category"].lower() or query in task["deadline"].lower()]
+    found += [note for note in notes if query in note["text"].lower() or query in note["category"].lower()]
+    return found
+
+def make_data(bot, count, rng):
+    user_data = bot.UserData(1)
+    for i in range(count):
+        # Rare words make the text of a few items unique, like real task names
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))) + f" #{rng.randrange(count)}"
+        if i % 3:
+            user_data.apply({"op": "add_task", "task": {
+                "id": user_data.new_task_id(), "text": text, "deadline": "", "category": rng.choice(user_data.categories),
+                "created": "2026-01-01 09:00:00", "completed": False, "completed_at": None, "due": None
+            }})
+        else:
+            user_data.apply({"op": "add_note", "note": {
+                "id": user_data.new_note_id(), "text": text, "task_id": 1, "category": rng.choice(user_data.categories), "created": "2026-01-01 09:00:00"
+            }})
+    return user_data
+
+def per_query(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        bot = load_bot()
+        for count in counts:
+            started = time.perf_counter()
+            user_data = make_data(bot, count, random.Random(count))
+            # The index is built on the first search
+            user_data.search_index
+            print(f"{count} items, indexed in {time.perf_counter() - started:.2f}s")
+            repeat = max(1, 100000 // count)
+            for query in QUERIES:
+                linear = per_query(lambda: linear_search(user_data.tasks.values(), user_data.notes.values(), query), repeat)
+                indexed = per_query(lambda: user_data.search_index.search(query), repeat)
+                print(f"  {query!r:>18}: linear {linear:8.2f} ms   index {indexed:8.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Startup benchmark: time loading every chat's snapshot with each snapshot format.
+
+Usage: python snapshot_startup.py [chats] [tasks per chat]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+from bot_loader import load_bot
+
+def make_data(bot, chat_id, task_count):
+    user_data = bot.UserData(chat_id)
+    for i in range(task_count):
+        task_id = user_data.new_task_id()
+        user_data.tasks[task_id] = {
+            "id": task_id,
+            "text": f"Task {i} for chat {chat_id}",
+            "deadline": "2026-01-01 10:00",
+            "category": user_data.categories[i % len(user_data.categories)],
+            "created": "2025-12-01 09:00:00.000000",
+            "completed": i % 3 == 0,
+            "completed_at": "2025-12-15 18:00:00.000000" if i % 3 == 0 else None
+        }
+        if i % 2 == 0:
+            note_id = user_data.new_note_id()
+            user_data.notes[note_id] = {
+                "id": note_id,
+                "text": f"Note for task {i}",
+                "task_id": task_id,
+                "category": user_data.tasks[task_id]["category"],
+                "created": "2025-12-02 09:00:00.000000"
+            }
+    return user_data.to_dict()
+
+def run(bot, codec, chats, task_count):
+    for name in os.listdir(bot.DATA_DIR):
+        os.remove(os.path.join(bot.DATA_DIR, name))
+    for chat_id in range(1, chats + 1):
+        data = make_data(bot, chat_id, task_count)
+        if codec == "legacy":
+            # Plain JSON without a header, as written before snapshots had checksums
+            del data["version"]
+            with open(bot.get_user_file(chat_id), 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        else:
+            bot.SNAPSHOT_CODEC = codec
+            bot.write_snapshot(bot.get_user_file(chat_id), data)
+    size = sum(os.path.getsize(os.path.join(bot.DATA_DIR, name)) for name in os.listdir(bot.DATA_DIR))
+
+    started = time.perf_counter()
+    for chat_id in bot.storage.chat_ids():
+        bot.storage.load(chat_id)
+    elapsed = time.perf_counter() - started
+    print(f"{codec:>8}: {elapsed:8.3f}s  {size / 1024 / 1024:8.1f} MB")
+
+def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    task_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        bot = load_bot()
+        print(f"{chats} chats x {task_count} tasks")
+        for codec in ["legacy", *bot.SNAPSHOT_CODECS]:
+            run(bot, codec, chats, task_count)
+
+if __name__ == "__main__":
+    main()
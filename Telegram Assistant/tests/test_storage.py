@@ -0,0 +1,276 @@
+"""Round-trip tests of the chat data storage: journal replay, compaction, recovery and migrations.
+
+Run from this folder: python -m unittest test_storage (or python -m pytest)
+"""
+import asyncio
+import hashlib
+import importlib.util
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+BOT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BOT_SCRIPTS = {
+    "en": os.path.join(BOT_FOLDER, "PM Assistant English Version", "PM Assistant Bot English Version.py"),
+    "uk": os.path.join(BOT_FOLDER, "PM Assistant Ukrainian version", "PM Assistant Bot Ukrainian version.py"),
+}
+_bots = {}
+
+def load_bot(language):
+    """Import a bot script once, in a folder of its own, since it creates its data files in the current directory"""
+    if language not in _bots:
+        os.environ.setdefault("BOT_TOKEN", "123456:" + "x" * 35)
+        os.environ["METRICS_PORT"] = "0"
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp())
+        try:
+            spec = importlib.util.spec_from_file_location(f"pm_bot_{language}", BOT_SCRIPTS[language])
+            bot = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(bot)
+        finally:
+            os.chdir(cwd)
+        _bots[language] = bot
+    return _bots[language]
+
+class StorageTests:
+    language = None
+
+    def setUp(self):
+        self.bot = load_bot(self.language)
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.TemporaryDirectory()
+        os.chdir(self.workdir.name)
+        os.makedirs(self.bot.DATA_DIR)
+        self.bot.users.clear()
+        self.bot.pending_changes.clear()
+        self.storage = self.bot.storage = self.bot.JsonStorage()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.workdir.cleanup()
+
+    def add_task(self, user_data, text, deadline=""):
+        task = {
+            "id": user_data.new_task_id(),
+            "text": text,
+            "deadline": deadline,
+            "category": user_data.categories[0],
+            "created": "2026-01-10 09:00:00",
+            "completed": False,
+            "completed_at": None,
+            "due": None
+        }
+        self.bot.commit_change(user_data, {"op": "add_task", "task": task})
+        return task
+
+    def add_note(self, user_data, text, task_id):
+        note = {
+            "id": user_data.new_note_id(),
+            "text": text,
+            "task_id": task_id,
+            "category": user_data.categories[0],
+            "created": "2026-01-10 10:00:00"
+        }
+        self.bot.commit_change(user_data, {"op": "add_note", "note": note})
+        return note
+
+    def make_changes(self, count, flush_every=1):
+        """Commit count changes to chat 1 and flush them, returns the chat's data as it is in memory"""
+        async def scenario():
+            user_data = await self.bot.get_user_data(1)
+            for i in range(count):
+                if i % 5 == 3:
+                    self.bot.commit_change(user_data, {"op": "complete_task", "task_id": user_data.next_task_id - 1, "at": "2026-01-11 12:00:00"})
+                elif i % 5 == 4:
+                    self.add_note(user_data, f"Note {i}", user_data.next_task_id - 1)
+                else:
+                    self.add_task(user_data, f"Task {i}")
+                if (i + 1) % flush_every == 0:
+                    await self.bot.flush_changes()
+            await self.bot.flush_changes()
+            return user_data
+        return asyncio.run(scenario())
+
+    def reload(self, chat_id=1):
+        self.bot.users.clear()
+        return self.storage.load(chat_id)
+
+    def test_commit_flush_reload(self):
+        user_data = self.make_changes(12, flush_every=4)
+        async def delete_some():
+            self.bot.users[1] = user_data
+            self.bot.commit_change(user_data, {"op": "delete_note", "note_id": 1})
+            self.bot.commit_change(user_data, {"op": "delete_task", "task_id": 1})
+            self.bot.commit_change(user_data, {"op": "reactivate_task", "task_id": 3})
+            await self.bot.flush_changes()
+        asyncio.run(delete_some())
+        loaded = self.reload()
+        self.assertEqual(loaded.to_dict(), user_data.to_dict())
+        self.assertEqual(loaded.seq, 15)
+
+    def test_compacted_journal_reloads(self):
+        self.storage.compact_every = 5
+        user_data = self.make_changes(12)
+        self.assertTrue(os.path.exists(self.bot.get_user_file(1, 1)))
+        loaded = self.reload()
+        self.assertEqual(loaded.to_dict(), user_data.to_dict())
+        self.assertFalse(loaded.recovered)
+
+    def test_recovery_from_damaged_generation(self):
+        self.storage.compact_every = 10
+        user_data = self.make_changes(25)
+        user_file = self.bot.get_user_file(1)
+        with open(user_file, "r+b") as f:
+            f.seek(-3, os.SEEK_END)
+            f.write(b"xyz")
+
+        # The older generation is rolled forward with its journal and the newer ones
+        loaded = self.reload()
+        self.assertEqual(loaded.to_dict(), user_data.to_dict())
+        self.assertTrue(loaded.recovered)
+
+        # The damaged snapshot is set aside and the next write compacts the chat again
+        self.assertTrue(os.path.exists(user_file + ".damaged"))
+        async def write():
+            self.bot.users[1] = loaded
+            self.bot.commit_change(loaded, {"op": "complete_task", "task_id": 1, "at": "2026-01-12 12:00:00"})
+            await self.bot.flush_changes()
+        asyncio.run(write())
+        self.assertFalse(loaded.recovered)
+        self.assertFalse(os.path.exists(self.bot.get_journal_file(1)))
+        with open(user_file + ".damaged", "rb") as f:
+            self.assertTrue(f.read().endswith(b"xyz"))
+        reloaded = self.reload()
+        self.assertEqual(reloaded.to_dict(), loaded.to_dict())
+        self.assertFalse(reloaded.recovered)
+        self.assertEqual(reloaded.journal_size, 0)
+
+    def test_no_readable_snapshot(self):
+        self.storage.compact_every = 5
+        self.make_changes(17)
+        files = {}
+        for generation in range(self.bot.SNAPSHOT_GENERATIONS):
+            with open(self.bot.get_user_file(1, generation), "r+b") as f:
+                f.seek(-3, os.SEEK_END)
+                f.write(b"xyz")
+        for name in os.listdir(self.bot.DATA_DIR):
+            with open(os.path.join(self.bot.DATA_DIR, name), "rb") as f:
+                files[name] = f.read()
+
+        # The chat isn't served as empty and none of its files are touched
+        with self.assertRaises(ValueError):
+            self.reload()
+        for name, content in files.items():
+            with open(os.path.join(self.bot.DATA_DIR, name), "rb") as f:
+                self.assertEqual(f.read(), content)
+        self.assertEqual(sorted(os.listdir(self.bot.DATA_DIR)), sorted(files))
+
+    def test_broken_journal_is_cut_at_last_record(self):
+        user_data = self.make_changes(6)
+        with open(self.bot.get_journal_file(1), "ab") as f:
+            f.write(b'{"op": "add_task", "seq": 7, "ta')
+        loaded = self.reload()
+        self.assertEqual(loaded.to_dict(), user_data.to_dict())
+        self.assertTrue(os.path.exists(self.bot.get_journal_file(1) + ".broken"))
+
+        # New records follow the last good one and are replayed after a restart
+        async def add():
+            self.bot.users[1] = loaded
+            self.add_task(loaded, "After the damage")
+            await self.bot.flush_changes()
+        asyncio.run(add())
+        self.assertEqual(self.reload().to_dict(), loaded.to_dict())
+
+    def test_positional_journal_records(self):
+        # A version 2 snapshot and journal, written before tasks and notes had ids
+        snapshot = {
+            "tasks": [
+                {"text": "First", "deadline": "", "category": "Work", "created": "2026-01-01 09:00:00",
+                 "completed": False, "completed_at": None, "due": None},
+                {"text": "Second", "deadline": "", "category": "Work", "created": "2026-01-01 09:00:00",
+                 "completed": False, "completed_at": None, "due": None},
+            ],
+            "notes": [{"text": "On second", "task_id": 1, "category": "Work", "created": "2026-01-01 10:00:00"}],
+            "categories": ["Work"],
+            "statistics": {"tasks_2026-01": 2},
+            "seq": 2,
+            "version": 2
+        }
+        with open(self.bot.get_user_file(1), "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        records = [
+            {"op": "complete_task", "task": 0, "at": "2026-01-02 12:00:00", "seq": 3},
+            {"op": "add_note", "note": {"text": "On first", "task_id": 0, "category": "Work", "created": "2026-01-02 13:00:00"}, "seq": 4},
+            {"op": "delete_note", "note": 0, "seq": 5},
+            {"op": "delete_task", "task": 1, "seq": 6},
+        ]
+        with open(self.bot.get_journal_file(1), "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+
+        loaded = self.reload()
+        self.assertEqual(loaded.seq, 6)
+        self.assertEqual(list(loaded.tasks), [1])
+        self.assertTrue(loaded.tasks[1]["completed"])
+        self.assertEqual([(note["id"], note["text"], note["task_id"]) for note in loaded.notes.values()], [(2, "On first", 1)])
+        self.assertEqual((loaded.next_task_id, loaded.next_note_id), (3, 3))
+
+    def test_legacy_snapshot_migration(self):
+        # Version 1: tasks as "text — deadline" strings, behind a PMSNAP1 header without a codec
+        body = json.dumps({
+            "tasks": ["Plain task", "Dated task — 2030-01-05 10:00"],
+            "notes": [{"text": "Note", "task_id": 1, "category": "", "created": "2026-01-01 10:00:00"}]
+        }).encode("utf-8")
+        with open(self.bot.get_user_file(1), "wb") as f:
+            f.write(f"PMSNAP1 {hashlib.sha256(body).hexdigest()} {len(body)}\n".encode() + body)
+
+        loaded = self.reload()
+        self.assertEqual([(task["id"], task["text"]) for task in loaded.tasks.values()], [(1, "Plain task"), (2, "Dated task")])
+        self.assertIsNone(loaded.tasks[1]["due"])
+        self.assertTrue(loaded.tasks[2]["due"].startswith("2030-01-05"))
+        self.assertEqual(loaded.notes[1]["task_id"], 2)
+        self.assertEqual(loaded.task_notes, {2: {1}})
+
+    def test_sqlite_schema_migration(self):
+        # A database from before deadlines were normalized and tasks had ids: notes.task_id is a task position
+        conn = sqlite3.connect("old.db")
+        conn.executescript("""
+            CREATE TABLE users (user_id INTEGER PRIMARY KEY);
+            CREATE TABLE tasks (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, text TEXT NOT NULL,
+                deadline TEXT NOT NULL DEFAULT '', category TEXT NOT NULL DEFAULT '', created TEXT NOT NULL,
+                completed INTEGER NOT NULL DEFAULT 0, completed_at TEXT);
+            CREATE TABLE notes (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, task_id INTEGER NOT NULL,
+                text TEXT NOT NULL, category TEXT NOT NULL DEFAULT '', created TEXT NOT NULL);
+            INSERT INTO users VALUES (1), (2);
+            INSERT INTO tasks (user_id, text, deadline, created) VALUES
+                (1, 'A', '', '2026-01-01 09:00:00'),
+                (2, 'Other chat', '', '2026-01-01 09:00:00'),
+                (1, 'B', '2030-01-05 10:00', '2026-01-01 09:00:00');
+            INSERT INTO notes (user_id, task_id, text, created) VALUES (1, 1, 'On B', '2026-01-01 10:00:00');
+        """)
+        conn.commit()
+        conn.close()
+
+        sqlite_storage = self.bot.SQLiteStorage("old.db")
+        loaded = sqlite_storage.load(1)
+        self.assertEqual([(task["id"], task["text"]) for task in loaded.tasks.values()], [(1, "A"), (2, "B")])
+        self.assertTrue(loaded.tasks[2]["due"].startswith("2030-01-05"))
+        self.assertEqual(loaded.notes[1]["task_id"], 2)
+        self.assertEqual((loaded.next_task_id, loaded.next_note_id), (3, 2))
+
+        # Changes after the migration use the new numbering
+        sqlite_storage.write_changes(1, [{"op": "delete_task", "task_id": 2}])
+        reloaded = self.bot.SQLiteStorage("old.db").load(1)
+        self.assertEqual(list(reloaded.tasks), [1])
+        self.assertEqual(reloaded.notes, {})
+        self.assertEqual(list(self.bot.SQLiteStorage("old.db").load(2).tasks), [1])
+
+class EnglishStorageTests(StorageTests, unittest.TestCase):
+    language = "en"
+
+class UkrainianStorageTests(StorageTests, unittest.TestCase):
+    language = "uk"
+
+if __name__ == "__main__":
+    unittest.main()